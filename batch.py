@@ -0,0 +1,153 @@
+''' Batch mode: flip local images and text corpora without connecting to slack.
+
+Work is done in this process by default, or spread across a pool of
+worker processes, and results are streamed to disk as they complete, so
+arbitrarily large inputs can be processed in bounded memory. Text is
+only flipped in a pool once there is enough of it to pay for the pool.
+'''
+
+import collections
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+
+import flipbot
+import flipdata
+
+# Items read ahead of the results, per worker process
+WINDOW = 4
+
+IMAGE_EXTENSIONS = {'.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp'}
+
+# Text is flipped without a user directory: <@USER> references are kept
+# as they are, with no name to flip.
+_flipper = flipbot.FlipMarkedupText({})
+
+class Stats:
+    '''Throughput counters for a batch job.'''
+    def __init__(self, label):
+        self.label = label
+        self.items = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.start = time.perf_counter()
+
+    def add(self, bytes_in, bytes_out):
+        self.items += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+
+    def report(self, out=sys.stderr):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        print('{}: {} items, {} errors in {:.2f}s '
+              '({:.1f} items/s, {:.2f} MB/s in, {:.2f} MB/s out)'.format(
+                  self.label, self.items, self.errors, elapsed,
+                  self.items / elapsed, self.bytes_in / elapsed / 1e6,
+                  self.bytes_out / elapsed / 1e6),
+              file=out)
+
+def _imap(func, items, jobs, min_items=0):
+    '''Map func over items in order, in a process pool unless jobs is 1.
+
+    If there are fewer than min_items items, they are mapped in this
+    process. Pool.imap reads all its input up front, so instead items are
+    submitted as results are taken, keeping WINDOW per process in flight.
+    '''
+    items = iter(items)
+    head = list(itertools.islice(items, min_items))
+    if jobs == 1 or len(head) < min_items:
+        yield from map(func, itertools.chain(head, items))
+        return
+    items = itertools.chain(head, items)
+    jobs = jobs or os.cpu_count()
+    with multiprocessing.Pool(jobs) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= WINDOW * jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+def flip_lines(lines):
+    '''Flip a chunk of lines of marked up text.
+
+    Returns a list of (length of line, flipped line).
+    '''
+    flipped = flipbot.flip_many([line.rstrip('\n') for line in lines], _flipper)
+    return [(len(line), f) for line, f in zip(lines, flipped)]
+
+def _chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+def flip_text_stream(lines, out, jobs=1, chunksize=256):
+    '''Flip lines of text, writing each result to out in input order.
+
+    With jobs other than 1, and at least flipbot.POOL_MIN_TEXTS lines, the
+    lines are flipped in a pool of worker processes, or one per CPU if jobs
+    is None or 0.
+    '''
+    stats = Stats('text')
+    if jobs != 1:
+        flipdata.data() # Build the flip tables here, not in every worker
+    min_chunks = -(-flipbot.POOL_MIN_TEXTS // chunksize)
+    for chunk in _imap(flip_lines, _chunks(lines, chunksize), jobs, min_chunks):
+        for size, flipped in chunk:
+            out.write(flipped + '\n')
+            stats.add(size, len(flipped))
+    return stats
+
+def flip_image_file(paths):
+    '''Flip the image at src, saving it to dst.
+
+    Returns (bytes read, bytes written), or None if the file could not
+    be flipped.
+    '''
+    src, dst = paths
+    try:
+        with open(src, 'rb') as f:
+            data = f.read()
+        flipped = flipbot.flip_image(data)
+        with open(dst, 'wb') as f:
+            f.write(flipped)
+        return len(data), len(flipped)
+    except Exception as e:
+        print(src, e, file=sys.stderr)
+
+def image_files(src_dir, out_dir):
+    '''Yield (src, dst) path pairs for the images in src_dir.'''
+    for name in sorted(os.listdir(src_dir)):
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+            yield os.path.join(src_dir, name), os.path.join(out_dir, name)
+
+def flip_image_dir(src_dir, out_dir, jobs=1):
+    '''Flip every image in src_dir, saving the results in out_dir.'''
+    stats = Stats('images')
+    for result in _imap(flip_image_file, image_files(src_dir, out_dir), jobs):
+        if result:
+            stats.add(*result)
+        else:
+            stats.errors += 1
+    return stats
+
+def main(args):
+    '''Run a batch job from parsed command line arguments.'''
+    os.makedirs(args.out, exist_ok=True)
+    if args.images:
+        flip_image_dir(args.images, args.out, args.jobs).report()
+    if args.text:
+        name = 'stdin.txt' if args.text == '-' else os.path.basename(args.text)
+        with open(os.path.join(args.out, name), 'w', encoding='utf-8') as out:
+            if args.text == '-':
+                flip_text_stream(sys.stdin, out, args.jobs).report()
+            else:
+                with open(args.text, encoding='utf-8') as src:
+                    flip_text_stream(src, out, args.jobs).report()
@@ -0,0 +1,291 @@
+''' Flipbot benchmarks.
+
+Run with: python bench_flipbot.py [name ...]
+'''
+
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ('PIL', 'requests', 'slackclient', 'upsidedown')
+
+def _python(code, repeat):
+    '''Return the median wall time of running code in a fresh interpreter.'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def bench_startup(repeat=10):
+    '''Interpreter startup cost of importing flipbot.'''
+    base = _python('pass', repeat)
+    flipbot = _python('import flipbot', repeat)
+    text = _python('import flipbot; flipbot.flip_markedup_text('
+                   '"hello", flipbot.FlipMarkedupText({}))', repeat)
+    print('startup: import flipbot {:.1f}ms, first text flip {:.1f}ms '
+          '(over bare interpreter)'.format(
+              (flipbot - base) * 1e3, (text - base) * 1e3))
+    loaded = subprocess.run(
+        [sys.executable, '-c', 'import sys, flipbot; print(*sorted(sys.modules))'],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+    print('startup: heavy modules loaded on import:',
+          [m for m in HEAVY_MODULES if m in loaded] or 'none')
+
+def bench_workspaces(count=100):
+    '''Memory cost of each workspace hosted in one process.'''
+    import tracemalloc
+    import config
+    import flipbot
+
+    class OfflineClient(flipbot.FlipClient):
+        def _find_users(self):
+            pass # Don't call the slack API
+
+    def client(i):
+        return OfflineClient(config.Config(token='xoxb-%d' % i, user='U%d' % i),
+                             connect=False)
+
+    client(0) # Load modules and warm up before measuring
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    clients = [client(i) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('workspaces: {:.1f}KB per workspace, for {} workspaces'.format(
+        (after - before) / len(clients) / 1024, len(clients)))
+
+def _best(f, *args, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def replay_corpus(count=20000, seed=1):
+    '''Return chat messages like those caught up after a reconnect.'''
+    import random
+    rng = random.Random(seed)
+    words = ('the deploy failed again can someone look at this log please '
+             'thanks lunch anyone meeting in five minutes').split()
+    markup = [':+1:', ':tada:', ':smile:', '<@U123>', '<@U456|ann>',
+              '<#C123|general>', '<!here>', '<http://example.com|the docs>',
+              'R&amp;D', '&lt;3']
+    return [' '.join(rng.choice(markup) if rng.random() < 0.1 else rng.choice(words)
+                     for _ in range(rng.randrange(3, 30)))
+            for _ in range(count)]
+
+def bench_flip_many(count=20000):
+    '''flip_many against a loop of flip_markedup_text calls.'''
+    import flipbot
+    flipper = flipbot.FlipMarkedupText({'@U123': 'bob'})
+    texts = replay_corpus(count)
+
+    def loop():
+        flipbot._cached_transform.cache_clear()
+        return [flipbot.flip_markedup_text(t, flipper) for t in texts]
+
+    def many(jobs=1):
+        flipbot._cached_transform.cache_clear()
+        return flipbot.flip_many(texts, flipper, jobs)
+    single = _best(loop)
+    for jobs in 1, 4:
+        batch = _best(many, jobs)
+        print('flip_many: {} messages, loop {:.3f}s flip_many(jobs={}) {:.3f}s '
+              '({:.2f}x)'.format(len(texts), single, jobs, batch, single / batch))
+
+# An RTM message event, as slack sends it
+RTM_EVENT = r'''{"client_msg_id": "5e8c1a2f-3b4d-4e5f-8a9b-0c1d2e3f4a5b",
+"type": "message", "text": "deploy failed again, see <http://ci.example.com/42|build 42> :cry:",
+"user": "U0123ABCD", "ts": "1700000000.%06d", "team": "T0123ABCD",
+"user_team": "T0123ABCD", "source_team": "T0123ABCD",
+"user_profile": {"avatar_hash": "g1234567890a", "image_72": "https://avatars.example.com/72.png",
+"first_name": "Ann", "real_name": "Ann Example", "display_name": "ann",
+"team": "T0123ABCD", "name": "ann", "is_restricted": false, "is_ultra_restricted": false},
+"blocks": [{"type": "rich_text", "block_id": "aB1c", "elements": [{"type": "rich_text_section",
+"elements": [{"type": "text", "text": "deploy failed again, see "},
+{"type": "link", "url": "http://ci.example.com/42", "text": "build 42"},
+{"type": "text", "text": " "}, {"type": "emoji", "name": "cry"}]}]}],
+"channel": "C0123ABCD", "event_ts": "1700000000.%06d", "channel_type": "channel"}'''
+
+def bench_messages(count=10000):
+    '''Memory and field access of queued events, as dicts and Messages.'''
+    import json
+    import tracemalloc
+    from message import Message
+
+    def queued(parse):
+        tracemalloc.start()
+        events = [parse(json.loads(RTM_EVENT % (n, n))) for n in range(count)]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return events, size
+    dicts, dict_size = queued(lambda event: event)
+    msgs, msg_size = queued(Message.parse)
+    print('messages: {:.0f} bytes per queued event dict, {:.0f} per Message '
+          '({:.1f}x smaller)'.format(dict_size / count, msg_size / count,
+                                     dict_size / msg_size))
+
+    def dict_fields():
+        for event in dicts:
+            event.get('type'), event.get('subtype') or None, event.get('user'), event['ts']
+    def msg_fields():
+        for msg in msgs:
+            msg.key, msg.user, msg.ts
+    print('messages: routing fields of {} events, dicts {:.2f}ms, Messages {:.2f}ms'
+          .format(count, _best(dict_fields) * 1e3, _best(msg_fields) * 1e3))
+
+def users_list(count=2000):
+    '''Return a users.list response body, as slack sends it.'''
+    import json
+    member = json.loads(RTM_EVENT % (0, 0))['user_profile']
+    return json.dumps({'ok': True, 'members': [
+        {'id': 'U%08d' % n, 'team_id': 'T0123ABCD', 'name': 'user%d' % n,
+         'deleted': False, 'color': '9f69e7', 'real_name': 'User %d' % n,
+         'tz': 'Europe/London', 'tz_label': 'British Summer Time',
+         'tz_offset': 3600, 'profile': member, 'is_admin': False,
+         'is_owner': False, 'is_bot': False, 'updated': 1700000000}
+        for n in range(count)]})
+
+def bench_json(count=1000):
+    '''Decoding recorded RTM frames and Web API responses with each parser.'''
+    import fastjson
+    frames = [RTM_EVENT % (n, n) for n in range(count)]
+    response = users_list()
+    for name in fastjson.PARSERS:
+        try:
+            codec = fastjson.Codec(name)
+        except ImportError:
+            print('json: {:6} not installed'.format(name))
+            continue
+
+        def rtm():
+            for frame in frames:
+                codec.loads(frame)
+
+        def api_call():
+            # slackclient decodes a response, encodes it again with its
+            # headers, then decodes it twice more.
+            body = codec.dumps(codec.loads(response))
+            codec.loads(body)
+            codec.loads(body)
+        print('json: {:6} {} RTM frames {:.2f}ms, users.list of {:.1f}MB {:.2f}ms'
+              .format(name, count, _best(rtm) * 1e3,
+                      len(response) / 1e6, _best(api_call) * 1e3))
+
+def bench_reactions(count=500, latency=0.002):
+    '''Reply time and reaction calls, reacting inline and from the queue.'''
+    import random
+    import reactions
+    calls = []
+
+    def api_call(method, **kwargs):
+        time.sleep(latency) # A slack API round trip
+        calls.append(method)
+        return {'ok': True}
+    # A busy channel, where some messages arrive as several events
+    rng = random.Random(1)
+    events = [('C1', '%d.0' % rng.randrange(int(count * 0.8))) for _ in range(count)]
+
+    start = time.perf_counter()
+    for channel, ts in events:
+        api_call('chat.postMessage')
+        api_call('reactions.add', channel=channel, timestamp=ts, name='umbrella')
+    inline = time.perf_counter() - start, calls.count('reactions.add')
+
+    del calls[:]
+    queue = reactions.ReactionQueue(api_call)
+    start = time.perf_counter()
+    with queue.holding():
+        for channel, ts in events:
+            api_call('chat.postMessage')
+            queue.add(channel, ts, 'umbrella')
+    replies = time.perf_counter() - start
+    queue.flush(60)
+    print('reactions: {} events, replies posted in {:.2f}s with {} reactions.add '
+          'inline, {:.2f}s with {} queued'.format(
+              count, inline[0], inline[1], replies, calls.count('reactions.add')))
+
+def bench_preview(width=4000, height=3000, preview=720):
+    '''Time to flip a large photo, and its preview sized thumbnail.'''
+    import io
+    import random
+    from PIL import Image
+    import flipbot
+
+    def jpeg(w, h):
+        # Noise compresses about as badly as a photo
+        rng = random.Random(1)
+        img = Image.frombytes('RGB', (w, h), rng.randbytes(w * h * 3))
+        stream = io.BytesIO()
+        img.save(stream, format='JPEG', quality=85)
+        return stream.getvalue()
+    full = jpeg(width, height)
+    thumb = jpeg(preview, preview * height // width)
+    for name, data in ('full', full), ('preview', thumb):
+        print('preview: {:7} {:.1f}MB flipped in {:.3f}s'.format(
+            name, len(data) / 1e6, _best(flipbot.flip_image, data, repeat=3)))
+
+def bench_render(lines=300):
+    '''Rendering a long log as an image, from the glyph atlas and with ImageDraw.'''
+    from PIL import Image, ImageDraw
+    import render
+    text = '\n'.join('2024-01-01 12:00:%02d ERROR worker.py:%d Traceback (most recent '
+                     'call last): job %d failed' % (n % 60, n, n) for n in range(lines))
+    atlas = render.atlas()
+    atlas.render(render.wrap(text)) # Fill the atlas
+
+    def image_draw():
+        wrapped = render.wrap(text)
+        img = Image.new('L', (1000, atlas.line_height * len(wrapped)), 255)
+        draw = ImageDraw.Draw(img)
+        for i, line in enumerate(wrapped):
+            draw.text((0, i * atlas.line_height), line, fill=0, font=atlas.font)
+    print('render: {} lines, atlas {:.3f}s (with PNG encoding {:.3f}s), '
+          'ImageDraw.text {:.3f}s'.format(
+              lines, _best(atlas.render, render.wrap(text)),
+              _best(render.render_text, text), _best(image_draw, repeat=2)))
+
+def bench_flipdata():
+    '''Startup and memory cost of the flip tables: mapped, and parsed as dicts.'''
+    import tracemalloc
+    import flipdata
+    flipdata.data() # Build flipdata.bin if needed
+
+    def mapped():
+        flipdata._data = None
+        flipdata.data().emoji(':smile:')
+
+    def parsed():
+        with open(flipdata.SOURCE, encoding='utf-8') as f:
+            dict(line.split() for line in f if line.count(':') == 4).get(':smile:')
+    print('flipdata: loading the emojis {:.3f}ms mapped, {:.3f}ms parsed'.format(
+        _best(mapped, repeat=20) * 1e3, _best(parsed, repeat=20) * 1e3))
+
+    tracemalloc.start()
+    data = flipdata.FlipData(flipdata._map(flipdata.PATH))
+    mapped_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    tracemalloc.start()
+    with open(flipdata.SOURCE, encoding='utf-8') as f:
+        emojis = dict(line.split() for line in f if line.count(':') == 4)
+    chars = {data._codes[i]: data.char(chr(data._codes[i]))
+             for i in range(len(data._codes))}
+    parsed_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('flipdata: {} emojis, {} characters, per process heap {:.1f}KB mapped '
+          '(file {:.1f}KB, shared), {:.1f}KB as dicts'.format(
+              len(emojis), len(chars), mapped_size / 1e3,
+              len(data._emoji_blob.obj) / 1e3, parsed_size / 1e3))
+
+def main(names):
+    benches = {name[len('bench_'):]: f
+               for name, f in globals().items() if name.startswith('bench_')}
+    for name in names or benches:
+        benches[name]()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,219 @@
+''' Flipbot configuration.
+
+Settings are read from the [SETTINGS] section of settings.ini, using the
+setting name in upper case, and can be overridden by FLIPBOT_<NAME>
+environment variables:
+
+    [SETTINGS]
+    TOKEN = xoxb-...
+    USER = U...
+    VERBOSE = no
+
+The flip policy is read from the [POLICY] section; see policy.py.
+
+To host several workspaces in one process, give each its own section,
+whose settings override the shared ones:
+
+    [WORKSPACE acme]
+    TOKEN = xoxb-...
+    USER = U...
+
+A Watcher reloads the settings when the file changes, so that a running
+bot can be reconfigured without dropping its connection.
+'''
+
+import configparser
+import copy
+import os
+import sys
+import threading
+
+from policy import Policy, parse_policy
+
+def _boolean(s):
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[s.lower()]
+    except KeyError:
+        raise ValueError('Not a boolean: %r' % s)
+
+def _ids(s):
+    return frozenset(s.split())
+
+class Config:
+    '''Typed flipbot settings.
+
+    A Config is treated as read-only once created: to change settings,
+    create a new Config and hand it to FlipClient.configure.
+    '''
+    # Setting name -> (type, default)
+    SETTINGS = {
+        # Slack API token and the bot's user id
+        'token': (str, None),
+        'user': (str, None),
+        # Print every event handled
+        'verbose': (_boolean, False),
+        # Only flip text messages, never loading the image libraries
+        'text_only': (_boolean, False),
+        # Reply in a thread under each message, not in the channel
+        'threaded': (_boolean, False),
+        # Signing secret used to verify Events API requests
+        'signing_secret': (str, None),
+        # Remember handled messages for dedup_window seconds, up to
+        # dedup_size of them, persisted in dedup_file if set
+        'dedup_file': (str, None),
+        'dedup_window': (float, 600.0),
+        'dedup_size': (int, 10000),
+        # Replies remembered so that edits can update them
+        'max_replies': (int, 1000),
+        # Post a flip of the largest thumbnail up to preview_size pixels
+        # first, replacing it with a flip of the full image in the
+        # background if the image is larger and replace_preview is set
+        'image_preview': (_boolean, False),
+        'preview_size': (int, 720),
+        'replace_preview': (_boolean, True),
+        # Text over render_text_over characters or render_lines_over lines
+        # is posted as an upside-down image, of render_columns wide text in
+        # the TrueType render_font, or the default font. 0 disables each.
+        'render_text_over': (int, 0),
+        'render_lines_over': (int, 0),
+        'render_columns': (int, 120),
+        'render_font': (str, None),
+        'render_font_size': (int, 14),
+        # Messages missed while disconnected are caught up unless older
+        'max_backlog_age': (float, 3600.0),
+        # Reconnect delays, in seconds, double from initial up to max
+        'reconnect_initial': (float, 1.0),
+        'reconnect_max': (float, 60.0),
+        # On shutdown, the ts of the last message seen is saved in
+        # state_file, for the next run to catch up from. Messages already
+        # received are handled for up to drain_timeout seconds.
+        'state_file': (str, None),
+        'drain_timeout': (float, 10.0),
+        # When messages are handled this many seconds after they were
+        # posted, stop reacting, then stop flipping images, then skip
+        # messages altogether. 0 disables each.
+        'shed_reactions_lag': (float, 60.0),
+        'shed_images_lag': (float, 300.0),
+        'max_message_age': (float, 0.0),
+        # Parser for slack frames and responses: orjson, ujson or json.
+        # By default, the fastest installed.
+        'json_parser': (str, None),
+        # Users who may send the bot commands in a DM, such as
+        # "profile [seconds]"
+        'admin_users': (_ids, frozenset()),
+        # Profiles, started by SIGUSR2 or an admin, last profile_seconds
+        # and are written to profile_dir
+        'profile_seconds': (float, 10.0),
+        'profile_dir': (str, '.'),
+        # Threads for slack API calls in host mode; 0 for one per workspace
+        'io_threads': (int, 0),
+        # Events API worker threads and queue size, per server process
+        'event_workers': (int, 4),
+        'event_queue_size': (int, 10000),
+    }
+
+    def __init__(self, policy=None, **settings):
+        for name, (_, default) in self.SETTINGS.items():
+            setattr(self, name, settings.pop(name, default))
+        if settings:
+            raise TypeError('Unknown settings: ' + ', '.join(sorted(settings)))
+        self.policy = policy or Policy()
+
+    def for_instance(self, name, shared=None):
+        '''Return a copy of these settings for one of several clients.
+
+        Clients sharing settings, such as the processes of an events server
+        or the workspaces of a host, each keep their state and dedup files in
+        <file>.<name>. If shared is given, only files the same as its are
+        renamed.
+        '''
+        instance = copy.copy(self)
+        for setting in 'state_file', 'dedup_file':
+            path = getattr(self, setting)
+            if path and (shared is None or path == getattr(shared, setting)):
+                setattr(instance, setting, '{}.{}'.format(path, name))
+        return instance
+
+    def __repr__(self):
+        return 'Config({})'.format(', '.join(
+            '{}={!r}'.format(name, '...' if name in ('token', 'signing_secret')
+                             else getattr(self, name))
+            for name in self.SETTINGS))
+
+WORKSPACE = 'WORKSPACE '
+
+def workspaces(path='settings.ini'):
+    '''Return the names of the workspaces in a settings file.'''
+    parser = configparser.ConfigParser()
+    parser.read(path)
+    return [s[len(WORKSPACE):] for s in parser.sections()
+            if s.startswith(WORKSPACE)]
+
+def load(path='settings.ini', environ=None, workspace=None, **overrides):
+    '''Load a Config from a settings file and the environment.
+
+    Settings for a named workspace override the environment, and keyword
+    arguments override everything.
+    '''
+    environ = os.environ if environ is None else environ
+    parser = configparser.ConfigParser()
+    parser.read(path)
+    shared = parser['SETTINGS'] if parser.has_section('SETTINGS') else {}
+    own = {}
+    if workspace:
+        if not parser.has_section(WORKSPACE + workspace):
+            raise ValueError('No such workspace: ' + workspace)
+        own = parser[WORKSPACE + workspace]
+    settings = {}
+    for name, (kind, _) in Config.SETTINGS.items():
+        key = name.upper()
+        value = own.get(key, environ.get('FLIPBOT_' + key, shared.get(key)))
+        if value is not None:
+            try:
+                settings[name] = kind(value)
+            except ValueError as e:
+                raise ValueError('Invalid setting {}: {}'.format(
+                    name.upper(), e)) from None
+    settings.update(overrides)
+    return Config(policy=parse_policy(parser), **settings)
+
+class Watcher:
+    '''Polls a settings file, calling on_change(config) when it changes.
+
+    The file is read by load(path, **overrides), which by default returns a
+    Config.
+    '''
+    def __init__(self, path, on_change, interval=2.0, load=load, **overrides):
+        self._path = path
+        self._on_change = on_change
+        self._load = load
+        self._interval = interval
+        self._overrides = overrides
+        self._mtime = self._stat()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def reload(self):
+        '''Reload the settings now.'''
+        try:
+            self._on_change(self._load(self._path, **self._overrides))
+        except Exception as e:
+            print('Settings not reloaded:', e, file=sys.stderr)
+
+    def _stat(self):
+        try:
+            return os.stat(self._path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _watch(self):
+        while not self._stop.wait(self._interval):
+            mtime = self._stat()
+            if mtime != self._mtime:
+                self._mtime = mtime
+                self.reload()
@@ -0,0 +1,184 @@
+''' Drop messages which slack delivers more than once.
+
+After a reconnect, RTM (and the Events API) may replay messages the bot has
+already seen. Messages are identified by (channel, ts), and remembered for a
+limited time window, up to a maximum count.
+
+A message is seen when its handling starts, and done when it ends. Only
+done messages are persisted, so a message being handled when the process
+dies is handled again after a restart.
+
+Several processes, such as those of an events server, can share a
+SharedIndex, so that a retry delivered to another process is dropped too.
+'''
+
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+# Compact the log once it has this many lines per message indexed
+COMPACT_AFTER = 2
+
+class SharedIndex:
+    '''The most recently seen messages, in memory shared between processes.
+
+    Create it before starting the processes. It holds the last maxlen
+    messages as 8 byte hashes of (channel, ts), in a ring, with the time
+    each was seen.
+    '''
+    def __init__(self, maxlen=10000):
+        self.maxlen = maxlen
+        self._hashes = multiprocessing.RawArray('B', 8 * maxlen)
+        self._times = multiprocessing.RawArray('d', maxlen)
+        self._next = multiprocessing.RawValue('L', 0)
+        self._lock = multiprocessing.Lock()
+
+    @staticmethod
+    def _hash(key):
+        return hashlib.blake2b(json.dumps(key).encode(), digest_size=8).digest()
+
+    def _find(self, h, now, window):
+        '''Return the slot holding h, seen within window, or None.'''
+        hashes = bytes(self._hashes)
+        i = hashes.find(h)
+        while i != -1:
+            if i % 8 == 0 and now - self._times[i // 8] <= window:
+                return i // 8
+            i = hashes.find(h, i + 1)
+        return None
+
+    def add(self, key, now, window):
+        '''Record a message, returning True if it was seen within window.'''
+        h = self._hash(key)
+        with self._lock:
+            if self._find(h, now, window) is not None:
+                return True
+            slot = self._next.value
+            memoryview(self._hashes).cast('B')[8 * slot:8 * slot + 8] = h
+            self._times[slot] = now
+            self._next.value = (slot + 1) % self.maxlen
+            return False
+
+    def remove(self, key, now, window):
+        '''Forget a message, if it was seen within window.'''
+        with self._lock:
+            slot = self._find(self._hash(key), now, window)
+            if slot is not None:
+                self._times[slot] = -float('inf')
+
+class Deduplicator:
+    '''A bounded, time-windowed index of recently seen messages.
+
+    If path is given, done messages are appended to that file, and
+    reloaded on construction so the index survives restarts.
+    The file is compacted when it grows to COMPACT_AFTER times maxlen lines.
+
+    If shared, a SharedIndex, is given, messages seen by the other
+    processes sharing it are seen here too. Each process should have its
+    own path.
+    '''
+    def __init__(self, window=600, maxlen=10000, path=None, shared=None):
+        self.window = window
+        self.maxlen = maxlen
+        self.dropped = 0
+        self._seen = collections.OrderedDict() # (channel, ts) -> time seen
+        self._handling = set() # (channel, ts) of messages seen, but not done
+        self._lock = threading.Lock()
+        self._path = path
+        self._shared = shared
+        self._log = None
+        self._log_lines = 0
+        if path:
+            self._load()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def seen(self, channel, ts, now=None):
+        '''Record a message, returning True if it has been seen before.'''
+        now = time.time() if now is None else now
+        key = channel, ts
+        with self._lock:
+            self._expire(now)
+            if key in self._seen or (
+                    self._shared and self._shared.add(key, now, self.window)):
+                self.dropped += 1
+                return True
+            self._add(key, now)
+            self._handling.add(key)
+            return False
+
+    def done(self, channel, ts):
+        '''Record that a seen message has been handled.'''
+        key = channel, ts
+        with self._lock:
+            self._handling.discard(key)
+            t = self._seen.get(key)
+            if self._log and t is not None:
+                self._log.write(json.dumps([channel, ts, t]) + '\n')
+                self._log.flush()
+                self._log_lines += 1
+                if self._log_lines > COMPACT_AFTER * self.maxlen:
+                    self._compact()
+
+    def forget(self, channel, ts):
+        '''Forget a seen message which wasn't handled, so it may be retried.'''
+        key = channel, ts
+        with self._lock:
+            self._handling.discard(key)
+            self._seen.pop(key, None)
+            if self._shared:
+                self._shared.remove(key, time.time(), self.window)
+
+    def close(self):
+        if self._log:
+            self._log.close()
+            self._log = None
+
+    def _add(self, key, now):
+        self._seen[key] = now
+        if len(self._seen) > self.maxlen:
+            self._handling.discard(self._seen.popitem(last=False)[0])
+
+    def _expire(self, now):
+        cutoff = now - self.window
+        seen = self._seen
+        while seen and next(iter(seen.values())) < cutoff:
+            self._handling.discard(seen.popitem(last=False)[0])
+
+    def _load(self):
+        '''Reload unexpired entries from the log, then compact it.'''
+        try:
+            with open(self._path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        channel, ts, t = json.loads(line)
+                    except ValueError:
+                        continue # Ignore a partly written last line
+                    self._add((channel, ts), t)
+        except FileNotFoundError:
+            pass
+        now = time.time()
+        self._expire(now)
+        if self._shared:
+            for key, t in self._seen.items():
+                self._shared.add(key, t, self.window)
+        self._compact()
+
+    def _compact(self):
+        '''Rewrite the log with only the done messages indexed, and reopen it.'''
+        self.close()
+        tmp = self._path + '.tmp'
+        lines = 0
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for key, t in self._seen.items():
+                if key not in self._handling:
+                    f.write(json.dumps([key[0], key[1], t]) + '\n')
+                    lines += 1
+        os.replace(tmp, self._path)
+        self._log = open(self._path, 'a', encoding='utf-8')
+        self._log_lines = lines
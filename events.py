@@ -0,0 +1,296 @@
+''' Receive slack events over HTTP, as an alternative to the RTM websocket.
+
+See: https://api.slack.com/apis/connections/events-api
+
+Requests are verified and acknowledged on an asyncio event loop, while the
+events themselves are queued and handled in worker threads, so slack's
+3 second acknowledgement deadline is met however slow a flip is. Several
+server processes can share one port.
+'''
+
+import asyncio
+import collections
+import hashlib
+import hmac
+import json
+import multiprocessing
+import queue
+import signal
+import statistics
+import sys
+import threading
+import time
+
+import fastjson
+
+MAX_BODY = 1 << 20
+MAX_CLOCK_SKEW = 300
+
+def signature(secret, timestamp, body):
+    '''Return the slack signature for a request body.'''
+    base = b'v0:' + timestamp.encode() + b':' + body
+    return 'v0=' + hmac.new(secret.encode(), base, hashlib.sha256).hexdigest()
+
+def verify_signature(secret, timestamp, body, sig, now=None):
+    '''Return True if sig is a valid, recent slack signature for body.'''
+    now = time.time() if now is None else now
+    try:
+        if abs(now - int(timestamp)) > MAX_CLOCK_SKEW:
+            return False # Possible replay attack
+    except (TypeError, ValueError):
+        return False
+    return hmac.compare_digest(signature(secret, timestamp, body), sig or '')
+
+class EventReceiver:
+    '''Verifies, acknowledges and queues slack events.
+
+    Queued events are passed to handle(event) by a pool of worker threads.
+    If given, parse(event) is applied to each event as it is queued, so that
+    the queue holds only what the handler needs. Requests are decoded with
+    the JSON parser json_parser, or the fastest installed.
+    '''
+    def __init__(self, handle, signing_secret, workers=4, queue_size=10000,
+                 parse=None, json_parser=None):
+        self.stats = collections.Counter()
+        self._codec = fastjson.Codec(json_parser)
+        self._handle = handle
+        self._parse = parse
+        self._secret = signing_secret
+        self._queue = queue.Queue(queue_size)
+        self._workers = [threading.Thread(target=self._work, daemon=True)
+                         for _ in range(workers)]
+        for w in self._workers:
+            w.start()
+
+    def dispatch(self, method, headers, body):
+        '''Respond to a request. Returns (status, content type, body).'''
+        if method != 'POST':
+            return 405, 'text/plain', b'POST only'
+        if not verify_signature(self._secret,
+                                headers.get('x-slack-request-timestamp'),
+                                body,
+                                headers.get('x-slack-signature')):
+            self.stats['bad_signature'] += 1
+            return 401, 'text/plain', b'Invalid signature'
+        try:
+            payload = self._codec.loads(body)
+        except ValueError:
+            return 400, 'text/plain', b'Invalid JSON'
+        if not isinstance(payload, dict):
+            self.stats['bad_event'] += 1
+            return 400, 'text/plain', b'Expected a JSON object'
+        kind = payload.get('type')
+        if kind == 'url_verification':
+            return 200, 'text/plain', str(payload.get('challenge', '')).encode()
+        if kind == 'event_callback':
+            try:
+                event = payload['event']
+                if self._parse:
+                    event = self._parse(event)
+            except Exception as e:
+                # Slack would only send it again, so acknowledge and drop it.
+                self.stats['bad_event'] += 1
+                print('Bad event:', e, file=sys.stderr)
+                return 200, 'text/plain', b''
+            try:
+                self._queue.put_nowait(event)
+            except queue.Full:
+                self.stats['rejected'] += 1
+                return 503, 'text/plain', b'Busy' # slack will retry
+            self.stats['queued'] += 1
+        return 200, 'text/plain', b''
+
+    def join(self):
+        '''Wait for all queued events to be handled.'''
+        self._queue.join()
+
+    def drain(self, timeout):
+        '''Wait up to timeout seconds for queued events to be handled.
+
+        Returns the number of events left unhandled.
+        '''
+        deadline = time.monotonic() + timeout
+        done = self._queue.all_tasks_done
+        with done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                done.wait(remaining)
+            return self._queue.unfinished_tasks
+
+    def _work(self):
+        while True:
+            event = self._queue.get()
+            try:
+                self._handle(event)
+            except Exception as e:
+                print(e, file=sys.stderr)
+            finally:
+                self._queue.task_done()
+
+    async def serve_connection(self, reader, writer):
+        '''Serve HTTP/1.1 requests on a keep-alive connection.'''
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method = request_line.decode('latin-1').split(' ', 1)[0]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    status, ctype, body = 413, 'text/plain', b'Too large'
+                    close = True
+                else:
+                    status, ctype, body = self.dispatch(
+                        method, headers, await reader.readexactly(length))
+                    close = headers.get('connection', '').lower() == 'close'
+                writer.write(('HTTP/1.1 {} {}\r\n'
+                              'Content-Type: {}\r\n'
+                              'Content-Length: {}\r\n'
+                              '{}\r\n').format(
+                                  status, _REASONS.get(status, ''), ctype,
+                                  len(body), 'Connection: close\r\n' if close else ''
+                              ).encode('latin-1') + body)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port, reuse_port=False, drain_timeout=10):
+        '''Serve requests until SIGINT or SIGTERM, then drain the queue.'''
+        server = await asyncio.start_server(self.serve_connection, host, port,
+                                            reuse_port=reuse_port)
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+        for signum in signal.SIGINT, signal.SIGTERM:
+            loop.add_signal_handler(signum, stopping.set)
+        async with server:
+            await stopping.wait()
+        # No more requests are accepted, so slack sends new events to
+        # other receivers, or retries them later.
+        left = await loop.run_in_executor(None, self.drain, drain_timeout)
+        if left:
+            print('Stopped with %d events unhandled' % left, file=sys.stderr)
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized',
+            405: 'Method Not Allowed', 413: 'Payload Too Large',
+            503: 'Service Unavailable'}
+
+def _serve_process(make_handle, instance, signing_secret, host, port,
+                   reuse_port, workers, queue_size, drain_timeout, parse,
+                   json_parser):
+    handle, finish = make_handle(instance)
+    receiver = EventReceiver(handle, signing_secret, workers, queue_size,
+                             parse, json_parser)
+    asyncio.run(receiver.serve(host, port, reuse_port, drain_timeout))
+    if finish:
+        finish()
+
+def serve(make_handle, signing_secret, host='0.0.0.0', port=3000, processes=1,
+          workers=4, queue_size=10000, drain_timeout=10, parse=None,
+          json_parser=None):
+    '''Run event receivers in several processes sharing one port.
+
+    make_handle(instance) is called in each process to create its event
+    handler, and returns (handle, finish). instance numbers the processes
+    from 0, or is None if there is only one. finish, if not None, is called
+    once the queue has drained, to finish the handler's background work.
+
+    Slack retries an event when it isn't acknowledged in time, and the
+    retry may reach any of the processes: to drop it, their handlers must
+    share what they have seen.
+    '''
+    if processes == 1:
+        return _serve_process(make_handle, None, signing_secret, host, port,
+                              False, workers, queue_size, drain_timeout, parse,
+                              json_parser)
+    procs = [multiprocessing.Process(target=_serve_process,
+                                     args=(make_handle, i, signing_secret,
+                                           host, port, True, workers,
+                                           queue_size, drain_timeout, parse,
+                                           json_parser))
+             for i in range(processes)]
+    for p in procs:
+        p.start()
+
+    def stop(signum, frame):
+        for p in procs:
+            p.terminate() # Each receiver drains its queue on SIGTERM
+    signal.signal(signal.SIGTERM, stop)
+    # A SIGINT from the terminal reaches the receivers directly.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for p in procs:
+        p.join()
+
+def _discard(event):
+    '''Event handler for load tests: ignores the event.'''
+
+def discarding_handler(instance=None):
+    '''Return an event handler which ignores events, and nothing to finish.'''
+    return _discard, None
+
+def make_event(n, channel='CLOADTEST'):
+    '''Return a synthetic event_callback payload for load testing.'''
+    return {'type': 'event_callback',
+            'event': {'type': 'message', 'channel': channel,
+                      'user': 'ULOADTEST', 'ts': '%d.%06d' % (time.time(), n),
+                      'text': 'Load test message %d :smile:' % n}}
+
+async def _post_events(host, port, secret, numbers, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for n in numbers:
+            body = json.dumps(make_event(n)).encode()
+            timestamp = str(int(time.time()))
+            start = time.perf_counter()
+            writer.write(('POST / HTTP/1.1\r\n'
+                          'Host: {}\r\n'
+                          'Content-Type: application/json\r\n'
+                          'Content-Length: {}\r\n'
+                          'X-Slack-Request-Timestamp: {}\r\n'
+                          'X-Slack-Signature: {}\r\n\r\n').format(
+                              host, len(body), timestamp,
+                              signature(secret, timestamp, body)
+                          ).encode('latin-1') + body)
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line == b'\r\n':
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            latencies.append((status, time.perf_counter() - start))
+    finally:
+        writer.close()
+
+async def load(host, port, secret, count=1000, connections=10):
+    '''Post count signed events, returning [(status, latency)].'''
+    latencies = []
+    await asyncio.gather(*(
+        _post_events(host, port, secret, range(i, count, connections), latencies)
+        for i in range(connections)))
+    return latencies
+
+def report(latencies, elapsed, out=sys.stderr):
+    '''Print load test results.'''
+    times = sorted(t for _, t in latencies)
+    statuses = collections.Counter(status for status, _ in latencies)
+    print('{} events in {:.2f}s ({:.0f}/s); latency median {:.1f}ms, '
+          'p99 {:.1f}ms; statuses {}'.format(
+              len(times), elapsed, len(times) / elapsed,
+              statistics.median(times) * 1e3,
+              times[int(len(times) * 0.99)] * 1e3, dict(statuses)),
+          file=out)
@@ -0,0 +1,85 @@
+''' Decode JSON with the fastest parser installed.
+
+slackclient decodes every RTM frame and Web API response with the standard
+library json module, which shows up in profiles at high event volume and
+on large users.list responses. A Codec uses orjson or ujson when one is
+installed, falling back to the standard library, and install() puts it in
+place of the json module in slackclient.
+'''
+
+import json
+import sys
+import threading
+
+def _orjson():
+    import orjson
+    return orjson.loads, lambda obj: orjson.dumps(obj).decode()
+
+def _ujson():
+    import ujson
+    return ujson.loads, ujson.dumps
+
+def _json():
+    return json.loads, json.dumps
+
+# Parser name -> function returning its (loads, dumps), fastest first
+PARSERS = {'orjson': _orjson, 'ujson': _ujson, 'json': _json}
+
+class Codec:
+    '''Stands in for the json module, using a faster parser if it can.
+
+    name is a key of PARSERS, or None for the fastest one installed. Calls
+    with options the parser may not support go to the standard library.
+    Decoding errors are ValueErrors, as with the standard library.
+    '''
+    JSONDecodeError = json.JSONDecodeError
+
+    def __init__(self, name=None):
+        if name is not None and name not in PARSERS:
+            raise ValueError('Unknown JSON parser: ' + name)
+        for parser in [name] if name else PARSERS:
+            try:
+                self._loads, self._dumps = PARSERS[parser]()
+            except ImportError:
+                if name:
+                    raise
+                continue
+            self.name = parser
+            break
+
+    def loads(self, s, **kwargs):
+        return json.loads(s, **kwargs) if kwargs else self._loads(s)
+
+    def dumps(self, obj, **kwargs):
+        return json.dumps(obj, **kwargs) if kwargs else self._dumps(obj)
+
+    def __repr__(self):
+        return 'Codec(%r)' % self.name
+
+# Modules which decode slack frames and responses
+SLACK_MODULES = ('slackclient.client', 'slackclient.server')
+
+def install(codec, modules=SLACK_MODULES):
+    '''Make modules use codec in place of the json module.'''
+    import importlib
+    for name in modules:
+        importlib.import_module(name).json = codec
+    return codec
+
+_installed = None # Codec installed in slackclient by use()
+_installed_lock = threading.Lock()
+
+def use(name=None):
+    '''Install a Codec for the parser name in slackclient, once per process.
+
+    slackclient's json module is global, so every client in a process
+    shares one parser: the first one asked for.
+    '''
+    global _installed
+    with _installed_lock:
+        if _installed is None:
+            _installed = install(Codec(name))
+        elif name and name != _installed.name:
+            print('JSON parser %s ignored: %s is in use' % (name, _installed.name),
+                  file=sys.stderr)
+        return _installed
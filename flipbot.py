@@ -3,132 +3,584 @@
 Thomas Guest, https://github.com/wordaligned/flipbot
 '''
 
-import configparser
-import html
+import collections
+import copy
+import functools
 import io
 import json
 import os
-import pprint
+import random
 import re
+import signal
 import sys
+import threading
 import time
-
-from PIL import Image
-import requests
-import slackclient
-import upsidedown
+import types
 
 import  emoji
-
-# Read Slack API token and the bot user name from settings.ini
-config = configparser.ConfigParser()
-config.read('settings.ini')
-
-TOKEN = config['SETTINGS']['TOKEN']
-USER = config['SETTINGS']['USER']
-VERBOSE = config['SETTINGS'].getboolean('VERBOSE')
+import config
+import fastjson
+import flipdata
+import profiler
+import shedding
+from dedup import Deduplicator, SharedIndex
+from message import Message
+from reactions import ReactionQueue
+
+# Pillow, requests, slackclient and upsidedown -- and stdlib modules only
+# needed when running the bot -- are imported where they are used, so that
+# importing this module stays cheap and text-only workers never load Pillow.
+
+# Routes slack events, keyed by (type, subtype), to FlipClient methods.
+# Events without a route are counted and dropped as soon as they arrive.
+ROUTES = {
+    ('message', None): '_on_text',
+    ('message', 'thread_broadcast'): '_on_text',
+    ('message', 'message_changed'): '_on_edit',
+    ('message', 'file_share'): '_on_file_share',
+    ('user_change', None): '_on_user_change',
+    ('team_join', None): '_on_user_change',
+    ('bot_added', None): '_on_user_change',
+    ('bot_updated', None): '_on_user_change',
+}
 
 class FlipClient:
-    '''Slack RTM client which flips messages.'''
+    '''Slack RTM client which flips messages.
 
-    def __init__(self, token, user):
-        self._client = slackclient.SlackClient(token)
-        self._user = user
+    With connect=False, events arrive some other way and only the Web API
+    is used. With connect=None, the caller connects, with connect_once,
+    then polls for messages and flips them.
+    '''
+
+    def __init__(self, config, connect=True, image_pool=None, shared_dedup=None):
+        import slackclient
+        fastjson.use(config.json_parser)
+        self._client = slackclient.SlackClient(config.token)
         self._api_call = self._client.api_call
-        if self._client.rtm_connect():
-            print("Flipbot connected and running!")
+        self.routed = collections.Counter()   # (type, subtype) -> count
+        self.filtered = collections.Counter() # (type, subtype) -> count
+        self._dedup = Deduplicator(config.dedup_window, config.dedup_size,
+                                   config.dedup_file, shared_dedup)
+        # Maps (channel, ts) of recent messages to the ts of our reply, so
+        # that edits can update the reply.
+        self._replies = collections.OrderedDict()
+        self._replies_lock = threading.Lock() # Events workers share _replies
+        # Sheds work when messages arrive late; shedder.level is a metric.
+        self.shedder = shedding.LoadShedder()
+        # Reactions are added in the background, once replies are posted.
+        self.reactions = ReactionQueue(self._api_call)
+        # Long texts rendered as images: images, chars and seconds taken
+        self.rendered = collections.Counter()
+        # Executor for image flips, which may be shared between clients.
+        self._image_pool = image_pool
+        # Replaces image previews with full size flips, in the background.
+        self._replacing = None
+        self._replacements = set()
+        self._flipper = FlipMarkedupText({})
+        self._users_stale = threading.Event()
+        self._users_refreshing = threading.Lock()
+        # The ts of the latest message seen, from which to catch up after
+        # a reconnect.
+        self._last_ts = None
+        self._stopping = threading.Event()
+        self._drain_deadline = None
+        self.connected = False
+        self.config = None
+        self.configure(config)
+        self._load_state()
+        if connect:
+            self._connect()
+        elif connect is not None:
             self._find_users()
-            self._flipper = FlipMarkedupText(self._users)
-        else:
-            print("Connection failed. Invalid Slack token or bot ID?")
+
+    def configure(self, config):
+        '''Apply new settings to the running client.
+
+        The token and user can't be changed without reconnecting, so a new
+        client is needed for those.
+        '''
+        old = self.config
+        if old and (config.token, config.user) != (old.token, old.user):
+            print('Token and user changes need a restart', file=sys.stderr)
+            config = copy.copy(config) # The caller's Config is read-only
+            config.token, config.user = old.token, old.user
+        self._routes = {key: getattr(self, name)
+                        for key, name in ROUTES.items()
+                        if not (config.text_only and name == '_on_file_share')}
+        self.shedder.thresholds = (config.shed_reactions_lag,
+                                   config.shed_images_lag,
+                                   config.max_message_age)
+        self._dedup.window = config.dedup_window
+        self._dedup.maxlen = config.dedup_size
+        self.policy = config.policy.inherit(old.policy) if old else config.policy
+        self.config = config
+
+    def _connect(self):
+        '''Connect to slack, retrying with exponential backoff.
+
+        Gives up if the client is stopped while waiting to retry.
+        '''
+        for delay in reconnect_delays(self.config.reconnect_initial,
+                                      self.config.reconnect_max):
+            if self.connect_once():
+                return
+            print("Connection failed, retrying in %.1fs. "
+                  "Invalid Slack token or bot ID?" % delay, file=sys.stderr)
+            if self._stopping.wait(delay):
+                return
+
+    def connect_once(self):
+        '''Try to connect to slack, returning True if connected.
+
+        Once connected, the user directory is loaded and messages missed
+        while disconnected are caught up.
+        '''
+        if not self._client.rtm_connect():
+            return False
+        self.connected = True
+        print("Flipbot connected and running!")
+        self._find_users()
+        self._catch_up()
+        return True
+
+    def _conversations(self):
+        '''Yield the ids of the conversations the bot is a member of.'''
+        cursor = None
+        while True:
+            r = self._api_call('users.conversations', cursor=cursor,
+                               types='public_channel,private_channel,mpim,im',
+                               exclude_archived=True, limit=200)
+            if not r.get('ok'):
+                return
+            for c in r['channels']:
+                yield c['id']
+            cursor = r.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return
+
+    def _history(self, channel, oldest):
+        '''Yield the messages in a channel since the oldest ts.'''
+        cursor = None
+        while True:
+            r = self._api_call('conversations.history', channel=channel,
+                               oldest=oldest, cursor=cursor, limit=200)
+            if not r.get('ok'):
+                return
+            for msg in r['messages']:
+                msg.setdefault('type', 'message')
+                msg['channel'] = channel
+                yield Message.parse(msg)
+            cursor = r.get('response_metadata', {}).get('next_cursor')
+            if not (r.get('has_more') and cursor):
+                return
+
+    def _catch_up(self):
+        '''Handle messages posted since the last one seen before a disconnect.'''
+        if self._last_ts is None:
+            return
+        oldest = max(float(self._last_ts),
+                     time.time() - self.config.max_backlog_age)
+        backlog = [msg
+                   for channel in self._conversations()
+                   for msg in self._history(channel, '%.6f' % oldest)]
+        backlog.sort(key=lambda msg: float(msg.ts))
+        self.flip(backlog)
 
     def _react(self, msg):
-        '''React to the message with a flipped emoji.'''
-        self._api_call('reactions.add',
-                       channel=msg['channel'],
-                       timestamp=msg['ts'],
-                       name=reaction())
+        '''Queue a reaction to the message with a flipped emoji.'''
+        self.reactions.add(msg.channel, msg.ts, reaction())
 
     def _flip_image_message(self, msg):
-        '''Respond to an image upload by posting a flipped version.'''
-        f = msg['file']
-        fname = f['name']
-        url = f['url_private_download']
-        meta = flip_file_metadata(f, self._flipper)
+        '''Respond to an image upload by posting a flipped version.
+
+        With the image_preview setting, a flip of a thumbnail is posted
+        first, and replaced by a flip of the full image in the background.
+        Returns True if a flip was posted.
+        '''
+        f = msg.file
+        thumb = f.thumb(self.config.preview_size) if self.config.image_preview else None
+        if thumb is None:
+            return self._post_flipped_image(msg, f.url) is not None
+        preview = self._post_flipped_image(msg, thumb[1])
+        if preview is None:
+            return self._post_flipped_image(msg, f.url) is not None
+        if self.config.replace_preview and (f.size is None or f.size > thumb[0]):
+            import concurrent.futures
+            if self._replacing is None:
+                self._replacing = concurrent.futures.ThreadPoolExecutor(1)
+            future = self._replacing.submit(self._replace_preview, msg, preview)
+            self._replacements.add(future)
+            future.add_done_callback(self._replacements.discard)
+        return True
+
+    def _replace_preview(self, msg, preview):
+        '''Post a flip of the full image, then delete its preview.'''
+        try:
+            if self._post_flipped_image(msg, msg.file.url) is not None and preview:
+                self._api_call('files.delete', file=preview)
+        except Exception as e:
+            print(e, file=sys.stderr)
+
+    def _post_flipped_image(self, msg, url):
+        '''Download the image at url, and upload a flipped version.
 
-        hdrs = {'Authorization': 'Bearer %s' % TOKEN}
+        Returns the id of the uploaded file, '' if slack didn't say, or
+        None if it wasn't uploaded.
+        '''
+        import requests
+        f = msg.file
+        hdrs = {'Authorization': 'Bearer %s' % self.config.token}
         resp = requests.get(url, headers=hdrs)
-        if resp.status_code == 200:
-            self._api_call('files.upload',
-                           filename=self._flipper.flip(fname),
-                           channels=msg['channel'],
-                           file=flip_image(resp.content),
-                           **meta)
-        else:
+        if resp.status_code != 200:
             print('Download failed', resp.content)
+            return None
+        if self._image_pool:
+            flipped = self._image_pool.submit(flip_image, resp.content).result()
+        else:
+            flipped = flip_image(resp.content)
+        r = self._api_call('files.upload',
+                           filename=self._flipper.flip(f.name),
+                           channels=msg.channel,
+                           file=flipped,
+                           **flip_file_metadata(f, self._flipper),
+                           **self._thread(msg))
+        return r.get('file', {}).get('id', '') if r.get('ok') else None
 
     def _flip_text_message(self, msg):
-        '''Respond to the text message by posting a flipped version.'''
-        text = msg['text']
-        self._api_call('chat.postMessage',
-                       channel=msg['channel'],
-                       text=flip_markedup_text(text, self._flipper),
-                       as_user=True)
+        '''Respond to the text message by posting a flipped version.
+
+        Returns True if it was posted.
+        '''
+        if self._is_long(msg.text):
+            posted = self._post_rendered_text(msg)
+            if posted is not None:
+                return posted
+        r = self._api_call('chat.postMessage',
+                           channel=msg.channel,
+                           text=flip_markedup_text(msg.text, self._flipper),
+                           as_user=True,
+                           **self._thread(msg))
+        if r.get('ok'):
+            with self._replies_lock:
+                self._replies[msg.channel, msg.ts] = r['ts']
+                if len(self._replies) > self.config.max_replies:
+                    self._replies.popitem(last=False)
+        return bool(r.get('ok'))
+
+    def _is_long(self, text):
+        '''Return True if text should be rendered as an image.'''
+        config = self.config
+        return not config.text_only and (
+            0 < config.render_text_over < len(text) or
+            0 < config.render_lines_over < text.count('\n') + 1)
+
+    def _post_rendered_text(self, msg):
+        '''Post the text of a message as an upside-down image.
+
+        Returns True if it was posted, or None if it couldn't be rendered.
+        The image isn't recorded as a reply, since edits can't update it.
+        '''
+        import render
+        start = time.perf_counter()
+        try:
+            image = render.render_text(plain_text(msg.text, self._flipper),
+                                       self.config.render_font,
+                                       self.config.render_font_size,
+                                       self.config.render_columns)
+        except Exception as e:
+            print('Rendering failed:', e, file=sys.stderr)
+            self.rendered['errors'] += 1
+            return None
+        seconds = time.perf_counter() - start
+        self.rendered.update(images=1, chars=len(msg.text), seconds=seconds)
+        self.rendered['max_seconds'] = max(self.rendered['max_seconds'], seconds)
+        r = self._api_call('files.upload',
+                           filename='flipped.png',
+                           channels=msg.channel,
+                           file=image,
+                           **self._thread(msg))
+        return bool(r.get('ok'))
+
+    def _flip_edited_message(self, msg):
+        '''Update our flipped reply to a message which has been edited.'''
+        edited = msg.edited
+        with self._replies_lock:
+            reply = self._replies.get((msg.channel, edited.ts))
+        if reply and edited.text != msg.previous_text:
+            self._api_call('chat.update',
+                           channel=msg.channel,
+                           ts=reply,
+                           text=flip_markedup_text(edited.text, self._flipper),
+                           as_user=True)
+
+    def _thread(self, msg):
+        '''Return the thread_ts argument to reply to msg, if any.'''
+        thread_ts = msg.thread_ts or (self.config.threaded and msg.ts)
+        return {'thread_ts': thread_ts} if thread_ts else {}
 
     def _find_users(self):
+        '''Load the user directory and publish it to the flipper.'''
         r = self._client.api_call('users.list')
         if r['ok']:
-            self._users = {'@' + m['id']: m['name'] for m in r['members']}
+            self._flipper.users = {'@' + m['id']: m['name'] for m in r['members']}
+
+    def _refresh_users(self):
+        '''Reload the user directory in a background thread.
+
+        Flips carry on using the current directory until the new one is
+        published. Requests made while a reload is running are coalesced
+        into a single further reload.
+        '''
+        self._users_stale.set()
+        if self._users_refreshing.acquire(blocking=False):
+            threading.Thread(target=self._users_refresher, daemon=True).start()
+
+    def _users_refresher(self):
+        while True:
+            while self._users_stale.is_set():
+                self._users_stale.clear()
+                try:
+                    self._find_users()
+                except Exception as e:
+                    print(e, file=sys.stderr)
+            self._users_refreshing.release()
+            # Pick up any request made after the last check.
+            if not (self._users_stale.is_set() and
+                    self._users_refreshing.acquire(blocking=False)):
+                return
+
+    def _on_user_change(self, msg):
+        self._refresh_users()
+
+    def _on_file_share(self, msg):
+        level = self.shedder.measure(msg.ts)
+        if (is_image_message(msg) and
+                self.shedder.allow(shedding.IMAGES, level) and
+                self.policy.allow(msg.channel, msg.user)):
+            if (self._flip_image_message(msg) and
+                    self.shedder.allow(shedding.REACTIONS, level)):
+                self._react(msg)
+
+    def _on_edit(self, msg):
+        if msg.edited and msg.edited.user != self.config.user:
+            self._flip_edited_message(msg)
+
+    def _on_text(self, msg):
+        if msg.channel.startswith('D') and self._admin_command(msg):
+            return
+        level = self.shedder.measure(msg.ts)
+        if (self.shedder.allow(shedding.MESSAGES, level) and
+                self.policy.allow(msg.channel, msg.user)):
+            if (self._flip_text_message(msg) and
+                    self.shedder.allow(shedding.REACTIONS, level)):
+                self._react(msg)
+
+    def _admin_command(self, msg):
+        '''Run a command sent by an admin in a DM, returning True if it was one.'''
+        words = (msg.text or '').split()
+        if not (words and words[0] == 'profile' and
+                msg.user in self.config.admin_users):
+            return False
+        try:
+            seconds = float(words[1]) if len(words) > 1 else self.config.profile_seconds
+        except ValueError:
+            seconds = None
+        if seconds is None or not seconds > 0: # Rejects nan too
+            text = ('Usage: profile [seconds], for up to %gs'
+                    % MAX_PROFILE_SECONDS)
+        else:
+            seconds = min(seconds, MAX_PROFILE_SECONDS)
+            path = profiler.start(seconds, self.config.profile_dir)
+            text = ('Profiling for %gs, writing %s' % (seconds, path)
+                    if path else 'Already profiling')
+        self._api_call('chat.postMessage', channel=msg.channel, as_user=True,
+                       text=text)
+        return True
 
     def _handle(self, msg):
-        if msg.get('user') == self._user:
+        '''Route a Message to its handler.'''
+        key = msg.key
+        route = self._routes.get(key)
+        if route is None:
+            self.filtered[key] += 1
+            return # Presence changes, typing, pongs and the like
+        if msg.user == self.config.user:
             return # Don't reprocess our own messages!
+        if msg.ts and self._dedup.seen(msg.channel, msg.ts):
+            return # Already handled, before a reconnect or restart
+        if msg.type == 'message':
+            if self._last_ts is None or float(msg.ts) > float(self._last_ts):
+                self._last_ts = msg.ts
+        self.routed[key] += 1
         try:
-            if VERBOSE:
-                pprint.pprint(msg)
-            if is_user_change(msg):
-                self._find_users()
-            elif is_image_message(msg):
-                self._flip_image_message(msg)
-                self._react(msg)
-            elif is_text_message(msg):
-                self._flip_text_message(msg)
-                self._react(msg)
+            if self.config.verbose:
+                print(msg)
+            route(msg)
         except Exception as e:
             print(e, file=sys.stderr)
-
-    def _messages(self):
-        while True:
-            yield from self._client.rtm_read()
-            time.sleep(1)
+            if msg.ts:
+                self._dedup.forget(msg.channel, msg.ts) # A retry may succeed
+            return
+        if msg.ts:
+            self._dedup.done(msg.channel, msg.ts)
+
+    def _read(self, reconnect=True):
+        '''Read messages from slack, reconnecting if the connection drops.'''
+        try:
+            events = self._client.rtm_read()
+        except Exception as e:
+            print('Connection lost:', e, file=sys.stderr)
+            self.connected = False
+            if reconnect and not self._stopping.is_set():
+                self._connect()
+            return []
+        msgs = []
+        for event in events:
+            try:
+                msgs.append(Message.parse(event))
+            except Exception as e: # Skip it, not the rest of the batch
+                print('Unreadable event:', e, file=sys.stderr)
+        return msgs
+
+    def poll(self):
+        '''Return the messages received since the last poll, without waiting.
+
+        If the connection has dropped, returns nothing, leaving the caller
+        to reconnect.
+        '''
+        return self._read(reconnect=False)
+
+    def flip(self, msgs):
+        '''Handle messages, unless stopping and the drain deadline has passed.
+
+        Reactions wait until the messages are handled.
+        '''
+        with self.reactions.holding():
+            for i, msg in enumerate(msgs):
+                if self._stopping.is_set() and time.monotonic() > self._drain_deadline:
+                    print('Stopped with %d messages unhandled, for the next run '
+                          'to catch up' % (len(msgs) - i), file=sys.stderr)
+                    return
+                self._handle(msg)
+
+    def _load_state(self):
+        if self.config.state_file:
+            try:
+                with open(self.config.state_file, encoding='utf-8') as f:
+                    self._last_ts = json.load(f)['last_ts']
+            except FileNotFoundError:
+                pass
+
+    def save_state(self):
+        '''Finish background work, and save the ts of the last message seen.
+
+        Full size image flips and queued reactions are posted, within the
+        drain timeout. The next run resumes from the saved ts.
+        '''
+        deadline = self._drain_deadline or time.monotonic() + self.config.drain_timeout
+        if self._replacements:
+            import concurrent.futures
+            _, unfinished = concurrent.futures.wait(
+                list(self._replacements), max(0, deadline - time.monotonic()))
+            if unfinished:
+                print('Stopped with %d image previews not replaced' % len(unfinished),
+                      file=sys.stderr)
+        unsent = self.reactions.flush(max(0, deadline - time.monotonic()))
+        if unsent:
+            print('Stopped with %d reactions unsent' % unsent, file=sys.stderr)
+        self._dedup.close()
+        if self.config.state_file:
+            tmp = self.config.state_file + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'last_ts': self._last_ts}, f)
+            os.replace(tmp, self.config.state_file)
+
+    @property
+    def stopping(self):
+        '''True once stop() has been called.'''
+        return self._stopping.is_set()
+
+    def stop(self):
+        '''Stop reading messages.
+
+        run() returns once the messages already received are handled, or
+        the drain_timeout setting has passed.
+        '''
+        self._drain_deadline = time.monotonic() + self.config.drain_timeout
+        self._stopping.set()
 
     def run(self):
-        for msg in self._messages():
-            self._handle(msg)
-
-def is_user_change(msg):
-    '''Return true if the users have been changed.'''
-    return msg['type'] in {'user_change',
-                           'team_join',
-                           'bot_added',
-                           'bot_updated'}
+        try:
+            while not self._stopping.is_set():
+                self.flip(self._read())
+                self._stopping.wait(1)
+            # Flip what slack had sent before we stopped reading.
+            self.flip(self._read())
+        finally:
+            self.save_state()
+
+MAX_PROFILE_SECONDS = 600
+
+def reconnect_delays(initial=1, maximum=60):
+    '''Yield exponentially increasing, jittered delays between reconnects.'''
+    delay = initial
+    while True:
+        yield min(delay * random.uniform(0.5, 1.5), maximum)
+        delay = min(delay * 2, maximum)
 
 def reaction():
     '''Return a reaction (emoji)'''
     return emoji.wrong_way_up()
 
 # https://api.slack.com/docs/message-formatting#how_to_display_formatted_messages
+# Markup can't nest, and slack escapes < and > in text, so a reference ends
+# at the first < or > -- which also keeps matching linear on input with
+# many unterminated <s.
 markup_re = re.compile(
-    '(:[-a-z0-9_\+]+:)'
-    '|'
-    '<(.*?)>')
+    r'(:[-a-z0-9_\+]+:)'
+    r'|'
+    r'<([^<>\n]*)>')
+
+# The flipper method for each kind of reference, by its first character;
+# others are links.
+_REF_METHODS = {'@': 'user', '#': 'channel', '!': 'command'}
+
+def flip_markup(m, flipper):
+    '''Flip a markup_re match: an emoji, or a reference.'''
+    if m.group(1):
+        return flipper.emoji(m.group(1))
+    ref, _, desc = m.group(2).partition('|')
+    return getattr(flipper, _REF_METHODS.get(ref[:1], 'link'))(ref, desc)
 
 class FlipMarkedupText:
     '''Text flip functions.'''
     def __init__(self, users):
         # The users arg maps from user id to user name, and is used to flip
         # <@USER|name> markup.
-        self._users = users
+        self.users = users
+
+    @property
+    def users(self):
+        '''Read-only snapshot of the user directory.'''
+        return self._users
+
+    @users.setter
+    def users(self, users):
+        # Publish a private, immutable copy: readers in other threads see
+        # either the old or the new snapshot, never a partial update, and
+        # need no lock.
+        self._users = types.MappingProxyType(dict(users))
+
+    def __getstate__(self):
+        # A MappingProxyType can't be pickled, so send a plain copy of the
+        # user directory to worker processes.
+        state = self.__dict__.copy()
+        state['_users'] = dict(self._users)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.users = state['_users']
 
     def unescape(self, s):
         '''Reverse the escapes used in slack markup.'''
@@ -144,7 +596,7 @@ class FlipMarkedupText:
     def flip(self, s):
         '''Flip latin characters in s to create an "upside-down" impression.'''
         s = self.unescape(s)
-        return upsidedown.transform(s)
+        return (_cached_transform if len(s) <= MAX_CACHED_LEN else _transform)(s)
 
     def emoji(self, s):
         '''Flips an emoji.'''
@@ -161,6 +613,22 @@ class FlipMarkedupText:
 
     command = channel = link
 
+# The flip of each character is looked up once, from the tables compiled
+# by flipdata, and strings flipped by str.translate.
+_FLIPS = {}
+
+def _transform(s):
+    s = s[::-1]
+    for c in set(s):
+        if ord(c) not in _FLIPS:
+            _FLIPS[ord(c)] = flipdata.data().char(c)
+    return s.translate(_FLIPS)
+
+# Flipped plain text is cached, and shared by every flipper in the process.
+# Long strings are rarely repeated, and would pin memory, so aren't cached.
+MAX_CACHED_LEN = 256
+_cached_transform = functools.lru_cache(maxsize=4096)(_transform)
+
 def flip_markedup_text(text, flipper):
     '''Flips text containing slack markup.
 
@@ -170,50 +638,112 @@ def flip_markedup_text(text, flipper):
     retaining link and user references, and identifying and flipping
     emojis
     '''
-    def flip_markup(m):
-        if m.group(1):
-            return flipper.emoji(m.group(1))
-        else:
-            ref, _, desc = m.group(2).partition('|')
-            return {
-                '@': flipper.user,
-                '#': flipper.channel,
-                '!': flipper.command
-                }.get(ref[0], flipper.link)(ref, desc)
-
     chunks = []
     pos = 0
     for m in markup_re.finditer(text):
         chunks.append(flipper.flip(text[pos:m.start()]))
-        chunks.append(flip_markup(m))
+        chunks.append(flip_markup(m, flipper))
         pos = m.end()
     chunks.append(flipper.flip(text[pos:]))
 
     return ''.join(reversed(chunks))
 
-def is_text_message(msg):
-    '''Return True if the message is simple text.'''
-    return msg.get('type') == 'message' and not msg.get('subtype')
+# Below this many texts, a pool of processes costs more than it saves:
+# starting one takes ~15ms, and passing a text to a worker and back ~5us,
+# against ~12us to flip it.
+POOL_MIN_TEXTS = 10000
+
+# A batch is flipped as one string, with its texts joined by _SEPARATOR and
+# its markup stood in for by _PLACEHOLDER. Markup can't span the newline, and
+# upsidedown leaves all three characters as they are.
+_SEPARATOR = '\n\x00'
+_PLACEHOLDER = '\x01'
+
+def flip_many(texts, flipper, jobs=1, chunksize=1000):
+    '''Flips many texts containing slack markup, returning a list in order.
+
+    Gives the same results as calling flip_markedup_text on each text, but
+    the markup of the whole batch is found in one pass, and all its plain
+    text flipped at once. With jobs other than 1, and at least
+    POOL_MIN_TEXTS texts, chunks of texts are flipped in a pool of worker
+    processes, or one per CPU if jobs is None.
+    '''
+    texts = list(texts)
+    if jobs != 1 and len(texts) >= max(POOL_MIN_TEXTS, chunksize + 1):
+        import multiprocessing
+        chunks = [(texts[i:i + chunksize], flipper)
+                  for i in range(0, len(texts), chunksize)]
+        flipdata.data() # Build the flip tables here, not in every worker
+        with multiprocessing.Pool(jobs) as pool:
+            return [flipped for chunk in pool.starmap(flip_many, chunks)
+                    for flipped in chunk]
+    # Flippers which flip text differently are given one text at a time.
+    if (not texts or
+            type(flipper).flip is not FlipMarkedupText.flip or
+            type(flipper).unescape is not FlipMarkedupText.unescape or
+            any('\x00' in text or _PLACEHOLDER in text for text in texts)):
+        return [flip_markedup_text(text, flipper) for text in texts]
+
+    markup = []
+    flipped = {} # Markup repeats a lot, so each is flipped once a batch
+    def placehold(m):
+        token = m.group()
+        if token not in flipped:
+            flipped[token] = flip_markup(m, flipper)
+        markup.append(flipped[token])
+        return _PLACEHOLDER
+
+    marked = markup_re.sub(placehold, _SEPARATOR.join(texts))
+    # Flipping reverses the batch: its texts, and the markup in them.
+    pieces = _transform(flipper.unescape(marked)).split(_PLACEHOLDER)
+    out = [None] * (2 * len(pieces) - 1)
+    out[::2] = pieces
+    out[1::2] = reversed(markup)
+    return ''.join(out).split(_SEPARATOR[::-1])[::-1]
+
+def plain_text(text, flipper):
+    '''Returns text containing slack markup as it reads in slack.'''
+    def plain(m):
+        if m.group(1):
+            return m.group(1)
+        ref, _, desc = m.group(2).partition('|')
+        kind = ref[:1]
+        if kind == '@':
+            return '@' + (desc or flipper.users.get(ref, ref[1:]))
+        if kind == '#':
+            return '#' + (desc or ref[1:])
+        if kind == '!':
+            return desc or '@' + ref[1:].partition('^')[0]
+        return desc or ref.partition('mailto:')[2] or ref
+
+    out = []
+    pos = 0
+    for m in markup_re.finditer(text):
+        out.append(flipper.unescape(text[pos:m.start()]))
+        out.append(plain(m))
+        pos = m.end()
+    out.append(flipper.unescape(text[pos:]))
+    return ''.join(out)
 
 def is_image_message(msg):
     '''Return True if the message is an image upload.'''
-    return (msg.get('type') == 'message' and
-            msg.get('subtype') == 'file_share' and
-            msg['file']['mimetype'].startswith('image'))
+    return (msg.type == 'message' and
+            msg.subtype == 'file_share' and
+            msg.file is not None and
+            msg.file.mimetype.startswith('image'))
 
 def flip_file_metadata(f, flipper):
     '''Returns flipped upload file metadata.'''
     meta = {}
-    title = f.get('title')
-    comment = f.get('initial_comment', {}).get('comment')
-    if title:
-        meta['title'] = flip_markedup_text(title, flipper)
-    if comment:
-        meta['initial_comment'] = flip_markedup_text(comment, flipper)
+    if f.title:
+        meta['title'] = flip_markedup_text(f.title, flipper)
+    if f.comment:
+        meta['initial_comment'] = flip_markedup_text(f.comment, flipper)
     return meta
 
 def flip_image(img_bytes):
     '''Returns binary image data representing a flipped version of the input data.'''
+    from PIL import Image
     stream = io.BytesIO(img_bytes)
     img = Image.open(stream)
     out = img.rotate(180)
@@ -222,6 +752,122 @@ def flip_image(img_bytes):
     stream.seek(0)
     return stream.read()
 
+def _client_handler(config, instance=None, shared_dedup=None):
+    '''Return the (handle, finish) of a client which doesn't use RTM.
+
+    Each of several server processes is a numbered instance, with its own
+    state files, dropping the messages of the others through shared_dedup.
+    '''
+    if instance is not None:
+        config = config.for_instance(instance)
+    client = FlipClient(config, connect=False, shared_dedup=shared_dedup)
+    return client._handle, client.save_state
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--settings', metavar='FILE', default='settings.ini',
+                        help='settings file (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='connect to slack and flip messages (default)')
+    run.add_argument('--dedup-file', metavar='FILE',
+                     help='remember handled messages across restarts in FILE')
+    batch = commands.add_parser('batch', help='flip local files without slack')
+    batch.add_argument('--images', metavar='DIR',
+                       help='directory of images to flip')
+    batch.add_argument('--text', metavar='FILE',
+                       help="text to flip, one message per line ('-' for stdin)")
+    batch.add_argument('--out', metavar='DIR', default='flipped',
+                       help='output directory (default: %(default)s)')
+    batch.add_argument('--jobs', type=int, default=1,
+                       help='worker processes, 0 for one per CPU; text is only '
+                            'split between them when there are at least %d '
+                            'lines (default: %%(default)s)' % POOL_MIN_TEXTS)
+    host = commands.add_parser('host',
+                               help='flip messages in every workspace in the settings')
+    host.add_argument('--image-processes', type=int, metavar='N',
+                      help='processes shared by all workspaces for image flips')
+    events = commands.add_parser('events', help='receive slack events over HTTP')
+    events.add_argument('--host', default='0.0.0.0')
+    events.add_argument('--port', type=int, default=3000)
+    events.add_argument('--processes', type=int, default=1,
+                        help='server processes sharing the port')
+    events.add_argument('--dry-run', action='store_true',
+                        help='acknowledge events without handling them')
+    load = commands.add_parser('events-load',
+                               help='load test an events receiver')
+    load.add_argument('--host', default='127.0.0.1')
+    load.add_argument('--port', type=int, default=3000)
+    load.add_argument('--count', type=int, default=1000)
+    load.add_argument('--connections', type=int, default=10)
+    for p in run, host:
+        p.add_argument('--text-only', action='store_const', const=True,
+                       help='only flip text, never loading the image libraries')
+        p.add_argument('--threaded', action='store_const', const=True,
+                       help='reply in threads rather than in the channel')
+        p.add_argument('--image-preview', action='store_const', const=True,
+                       help='post a flip of a thumbnail first, then the full image')
+    for p in events, load:
+        p.add_argument('--signing-secret',
+                       help='default: the SIGNING_SECRET setting')
+    args = parser.parse_args(argv)
+    # Command line options override the settings file and environment.
+    overrides = {name: value for name, value in vars(args).items()
+                 if name in config.Config.SETTINGS and value is not None}
+    settings = config.load(args.settings, **overrides)
+    if args.command != 'events-load':
+        # Build the flip tables now, not on the first message, and before
+        # any processes start, which then share them.
+        flipdata.data()
+
+    if args.command == 'batch':
+        import batch
+        if not (args.images or args.text):
+            parser.error('batch needs --images and/or --text')
+        batch.main(args)
+        return
+    if args.command == 'host':
+        import hosting
+        hosting.main(args.settings, args.image_processes, **overrides)
+        return
+    if args.command in ('events', 'events-load'):
+        import asyncio
+        import events
+        if not settings.signing_secret:
+            parser.error('a signing secret is needed to verify events')
+        if args.command == 'events-load':
+            start = time.perf_counter()
+            latencies = asyncio.run(events.load(
+                args.host, args.port, settings.signing_secret,
+                args.count, args.connections))
+            events.report(latencies, time.perf_counter() - start)
+            return
+    if not (settings.token and settings.user):
+        parser.error('TOKEN and USER must be set in %s' % args.settings)
+    if args.command == 'events':
+        # Server processes inherit the handler, so each can be profiled.
+        profiler.install(settings.profile_seconds, settings.profile_dir)
+        shared = (SharedIndex(settings.dedup_size)
+                  if args.processes > 1 and not args.dry_run else None)
+        make_handle = (events.discarding_handler if args.dry_run else
+                       functools.partial(_client_handler, settings,
+                                         shared_dedup=shared))
+        events.serve(make_handle, settings.signing_secret,
+                     args.host, args.port, args.processes,
+                     settings.event_workers, settings.event_queue_size,
+                     settings.drain_timeout,
+                     parse=None if args.dry_run else Message.parse,
+                     json_parser=settings.json_parser)
+    else:
+        client = FlipClient(settings)
+        watcher = config.Watcher(args.settings, client.configure, **overrides)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: watcher.reload())
+            signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.start(
+                client.config.profile_seconds, client.config.profile_dir))
+        for signum in signal.SIGINT, signal.SIGTERM:
+            signal.signal(signum, lambda signum, frame: client.stop())
+        client.run()
+
 if __name__ == "__main__":
-    client = FlipClient(TOKEN, USER)
-    client.run()
+    main()
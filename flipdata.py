@@ -0,0 +1,181 @@
+''' Compiled emoji and character flip tables, shared between processes.
+
+The emoji flips in emoji.txt and the flip of every character upsidedown
+changes are compiled into flipdata.bin, which is memory mapped on first
+use. Nothing is parsed at import, and every worker process shares one
+copy of the tables in the page cache, looking entries up by binary search.
+
+flipdata.bin is built when it is missing, older than emoji.txt or built
+with another version of upsidedown. Building takes a couple of seconds, so
+flipbot loads it at startup, before connecting or starting any worker
+processes. Where the directory is read-only, build it at install time:
+python flipdata.py
+'''
+
+import bisect
+import mmap
+import os
+import struct
+import sys
+import threading
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE = os.path.join(_HERE, 'emoji.txt')
+PATH = os.path.join(_HERE, 'flipdata.bin')
+
+# Magic, with the byte order of the tables, the version of upsidedown the
+# tables were built with, then the number of emojis and of characters. The
+# header is followed by native uint32 arrays:
+#   emoji offsets, 2 per emoji and 1 more: its name and flip in the blob
+#   character codes, ascending
+#   character offsets, 1 per character and 1 more
+# then the emoji blob and the character blob, both UTF-8.
+MAGIC = b'FLIPD2' + sys.byteorder[0].encode() + b'\0'
+HEADER = struct.Struct('=8s32sII')
+
+def upsidedown_version():
+    '''Return the installed version of upsidedown, without importing it.'''
+    import importlib.metadata
+    try:
+        return importlib.metadata.version('upsidedown')
+    except importlib.metadata.PackageNotFoundError:
+        return ''
+
+def _utf8(s):
+    # Lone surrogates can be flipped, but aren't valid UTF-8
+    return s.encode('utf-8', 'surrogatepass')
+
+def build(source=None):
+    '''Return the compiled tables of emoji.txt, or source, as bytes.'''
+    import array
+    import upsidedown
+    emojis = {}
+    with open(source or SOURCE, encoding='utf-8') as f:
+        for line in f:
+            words = line.split()
+            if words and not words[0].startswith('#'):
+                emojis[words[0]] = words[1] if len(words) > 1 else ''
+    chars = {}
+    for code in range(sys.maxunicode + 1):
+        flipped = upsidedown.transform(chr(code))
+        if flipped != chr(code):
+            chars[code] = flipped
+
+    def table(pairs):
+        offsets, blob = array.array('I', [0]), bytearray()
+        for value in pairs:
+            blob += _utf8(value)
+            offsets.append(len(blob))
+        return offsets, bytes(blob)
+    names = sorted(emojis)
+    emoji_offsets, emoji_blob = table(s for name in names for s in (name, emojis[name]))
+    codes = sorted(chars)
+    char_offsets, char_blob = table(chars[code] for code in codes)
+    return b''.join([HEADER.pack(MAGIC, upsidedown_version().encode(),
+                                 len(names), len(codes)),
+                     emoji_offsets.tobytes(),
+                     array.array('I', codes).tobytes(),
+                     char_offsets.tobytes(),
+                     emoji_blob, char_blob])
+
+def write(path=None, source=None):
+    '''Compile the tables into flipdata.bin, or path.'''
+    path = path or PATH
+    data = build(source)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return data
+
+class FlipData:
+    '''Looks up flips in compiled tables, held in a buffer such as an mmap.'''
+    def __init__(self, buf):
+        magic, version, emojis, chars = HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError('Not a flip data file, or from another platform')
+        self.version = version.rstrip(b'\0').decode() # of upsidedown
+        view = memoryview(buf)
+        pos = HEADER.size
+
+        def uints(n):
+            nonlocal pos
+            start, pos = pos, pos + 4 * n
+            return view[start:pos].cast('I')
+        self._emoji_offsets = uints(2 * emojis + 1)
+        self._codes = uints(chars)
+        self._char_offsets = uints(chars + 1)
+        self._emoji_blob = view[pos:pos + self._emoji_offsets[-1]]
+        pos += self._emoji_offsets[-1]
+        self._char_blob = view[pos:pos + self._char_offsets[-1]]
+        self._names = _Names(self)
+
+    def _emoji(self, i):
+        offsets = self._emoji_offsets
+        return str(self._emoji_blob[offsets[i]:offsets[i + 1]], 'utf-8')
+
+    def emoji(self, name):
+        '''Return the flip of an emoji, '' for a generic one, or None if unknown.'''
+        i = bisect.bisect_left(self._names, name)
+        if i < len(self._names) and self._names[i] == name:
+            return self._emoji(2 * i + 1)
+        return None
+
+    def char(self, c):
+        '''Return the flip of a character.'''
+        code = ord(c)
+        i = bisect.bisect_left(self._codes, code)
+        if i < len(self._codes) and self._codes[i] == code:
+            offsets = self._char_offsets
+            return str(self._char_blob[offsets[i]:offsets[i + 1]],
+                       'utf-8', 'surrogatepass')
+        return c
+
+class _Names:
+    '''The sorted emoji names, as a sequence for bisect.'''
+    def __init__(self, data):
+        self._data = data
+        self._len = (len(data._emoji_offsets) - 1) // 2
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        return self._data._emoji(2 * i)
+
+_data = None
+_lock = threading.Lock()
+
+def data():
+    '''Return the FlipData of this process, mapping the file on first use.'''
+    global _data
+    if _data is None:
+        with _lock:
+            if _data is None:
+                _data = FlipData(_load())
+    return _data
+
+def _load():
+    try:
+        if os.stat(PATH).st_mtime >= os.stat(SOURCE).st_mtime:
+            buf = _map(PATH)
+            if FlipData(buf).version == upsidedown_version():
+                return buf
+    except (OSError, ValueError, struct.error):
+        pass
+    try:
+        write()
+    except OSError as e: # Can't write beside the source: keep them in memory
+        print('Warning: flip data not saved ({}), so every process builds '
+              'its own copy. Run python flipdata.py to save it.'.format(e),
+              file=sys.stderr)
+        return build()
+    return _map(PATH)
+
+def _map(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+if __name__ == '__main__':
+    write()
+    print('Wrote', PATH)
@@ -0,0 +1,135 @@
+''' Host flipbot for several slack workspaces in one process.
+
+Each workspace has its own FlipClient, with its own connection, user
+directory and flip policy, but they share one event loop, one pool of
+threads for slack API calls, one pool of processes for image flips and
+the process-wide text flip cache. Adding a workspace costs a client
+object, not an interpreter.
+'''
+
+import asyncio
+import concurrent.futures
+import signal
+import sys
+
+import config
+import fastjson
+import flipbot
+import profiler
+
+class Host:
+    '''Runs FlipClients for many workspaces on one event loop.'''
+    def __init__(self, configs, io_threads=0, image_processes=None,
+                 profile=(10, '.')):
+        # configs maps from workspace name to Config. Each workspace makes
+        # one blocking call at a time, so by default (io_threads=0) the
+        # pool has a thread per workspace.
+        self.configs = dict(configs)
+        self.clients = {}
+        self._stopping = False
+        self._io = concurrent.futures.ThreadPoolExecutor(
+            io_threads or max(1, len(self.configs)))
+        # Image processes are profiled, for profile = (seconds, directory),
+        # on SIGUSR2.
+        self._images = (concurrent.futures.ProcessPoolExecutor(
+                            image_processes, initializer=profiler.install,
+                            initargs=profile)
+                        if image_processes else None)
+
+    def configure(self, configs):
+        '''Apply new settings to the running workspaces.'''
+        for name, client in self.clients.items():
+            if name in configs:
+                client.configure(configs[name])
+
+    async def run(self, poll_interval=1.0):
+        '''Connect every workspace and flip their messages until cancelled.'''
+        try:
+            await asyncio.gather(*(self._serve(name, c, poll_interval)
+                                   for name, c in self.configs.items()))
+        finally:
+            self._io.shutdown(wait=False)
+            if self._images:
+                self._images.shutdown(wait=False)
+
+    async def _serve(self, name, config, poll_interval):
+        loop = asyncio.get_running_loop()
+        # Connecting, reading and handling messages block on slack API
+        # calls, so are run in the shared thread pool. Waits between
+        # reconnects are on the event loop, so a workspace which can't
+        # connect doesn't hold a thread.
+        client = await loop.run_in_executor(
+            self._io, lambda: flipbot.FlipClient(config, connect=None,
+                                                 image_pool=self._images))
+        self.clients[name] = client
+        if self._stopping: # Stopped while starting
+            client.stop()
+        while not client.stopping:
+            if not client.connected:
+                await self._connect(name, client, poll_interval)
+                continue
+            msgs = await loop.run_in_executor(self._io, client.poll)
+            # Messages within a workspace are handled in order.
+            await loop.run_in_executor(self._io, client.flip, msgs)
+            if not msgs:
+                await asyncio.sleep(poll_interval)
+        if client.connected:
+            msgs = await loop.run_in_executor(self._io, client.poll)
+            await loop.run_in_executor(self._io, client.flip, msgs)
+        client.save_state()
+
+    async def _connect(self, name, client, poll_interval):
+        '''Connect a client, retrying until it connects or is stopped.'''
+        loop = asyncio.get_running_loop()
+        for delay in flipbot.reconnect_delays(client.config.reconnect_initial,
+                                              client.config.reconnect_max):
+            if await loop.run_in_executor(self._io, client.connect_once):
+                return
+            print('%s: connection failed, retrying in %.1fs' % (name, delay),
+                  file=sys.stderr)
+            deadline = loop.time() + delay
+            while loop.time() < deadline:
+                if client.stopping:
+                    return
+                await asyncio.sleep(min(poll_interval, deadline - loop.time()))
+
+    def stop(self):
+        '''Stop every workspace, letting each drain its messages.'''
+        self._stopping = True
+        for client in self.clients.values():
+            client.stop()
+
+def load(path='settings.ini', **overrides):
+    '''Load the Config of every workspace in a settings file.
+
+    A state or dedup file shared by workspaces becomes one per workspace,
+    <file>.<name>, so that they don't overwrite each other's.
+    '''
+    shared = config.load(path, **overrides)
+    configs = {}
+    for name in config.workspaces(path):
+        own = config.load(path, workspace=name, **overrides)
+        configs[name] = own.for_instance(name, shared)
+    return configs
+
+def main(path, image_processes=None, **overrides):
+    '''Host every workspace in a settings file, reloading it on change.'''
+    shared = config.load(path, **overrides)
+    fastjson.use(shared.json_parser) # Shared by every workspace
+    profile = shared.profile_seconds, shared.profile_dir
+    host = Host(load(path, **overrides), shared.io_threads,
+                image_processes=image_processes, profile=profile)
+    if not host.configs:
+        sys.exit('No [WORKSPACE name] sections in ' + path)
+    watcher = config.Watcher(path, host.configure, load=load, **overrides)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        for signum in signal.SIGINT, signal.SIGTERM:
+            loop.add_signal_handler(signum, host.stop)
+        loop.add_signal_handler(signal.SIGUSR2, profiler.start, *profile)
+        await host.run()
+    try:
+        asyncio.run(run())
+    finally:
+        watcher.stop()
@@ -0,0 +1,109 @@
+''' Compact messages, parsed from slack events as they arrive.
+
+A slack event carries far more than flipbot uses: blocks, team and client
+ids, user profiles, file previews. Each event is parsed into a Message
+holding only the fields flipbot needs, so events waiting in a queue or a
+catch up backlog take a fraction of the memory of their JSON, and fields
+are plain attributes rather than nested dict lookups.
+'''
+
+import sys
+
+def _intern(s):
+    # Ids and types repeat from message to message, so share one copy.
+    return sys.intern(s) if s and isinstance(s, str) else None
+
+def _id(value):
+    # user_change and team_join carry a user object, and channel events
+    # such as channel_joined carry a channel object, rather than an id.
+    if isinstance(value, dict):
+        value = value.get('id')
+    return _intern(value)
+
+class File:
+    '''An uploaded file.'''
+    __slots__ = ('name', 'mimetype', 'url', 'title', 'comment', 'size', 'thumbs')
+
+    def __init__(self, name=None, mimetype='', url=None, title=None,
+                 comment=None, size=None, thumbs=()):
+        self.name = name
+        self.mimetype = mimetype
+        self.url = url         # Private download URL
+        self.title = title
+        self.comment = comment # The comment posted with the upload
+        self.size = size       # Larger side of an image, in pixels, if known
+        self.thumbs = thumbs   # (size, url) of each thumbnail, smallest first
+
+    @classmethod
+    def parse(cls, f):
+        sides = [f[side] for side in ('original_w', 'original_h')
+                 if isinstance(f.get(side), int)]
+        # Thumbnails are thumb_<size>, fitting in a square of that size
+        thumbs = sorted((int(key[6:]), url) for key, url in f.items()
+                        if key.startswith('thumb_') and key[6:].isdigit())
+        return cls(f.get('name'),
+                   _intern(f.get('mimetype')) or '',
+                   f.get('url_private_download'),
+                   f.get('title'),
+                   (f.get('initial_comment') or {}).get('comment'),
+                   max(sides) if sides else None,
+                   tuple(thumbs))
+
+    def thumb(self, size):
+        '''Return the (size, url) of the largest thumbnail up to size, or None.'''
+        fits = [thumb for thumb in self.thumbs if thumb[0] <= size]
+        return fits[-1] if fits else None
+
+    def __repr__(self):
+        return _repr(self)
+
+class Message:
+    '''A slack event: a message, or some other event flipbot routes.
+
+    Fields missing from the event are None.
+    '''
+    __slots__ = ('type', 'subtype', 'channel', 'ts', 'user', 'text',
+                 'thread_ts', 'file', 'edited', 'previous_text')
+
+    def __init__(self, type=None, subtype=None, channel=None, ts=None,
+                 user=None, text=None, thread_ts=None, file=None,
+                 edited=None, previous_text=None):
+        self.type = type
+        self.subtype = subtype
+        self.channel = channel
+        self.ts = ts
+        self.user = user
+        self.text = text
+        self.thread_ts = thread_ts
+        self.file = file     # File, for file shares
+        self.edited = edited # Message as edited, for message_changed
+        self.previous_text = previous_text # Text before the edit
+
+    @classmethod
+    def parse(cls, event):
+        '''Parse a slack event dict.'''
+        f = event.get('file') or (event.get('files') or [None])[0]
+        edited = event.get('message')
+        return cls(_intern(event.get('type')),
+                   _intern(event.get('subtype')),
+                   _id(event.get('channel')),
+                   event.get('ts'),
+                   _id(event.get('user')),
+                   event.get('text'),
+                   event.get('thread_ts'),
+                   File.parse(f) if f else None,
+                   cls.parse(edited) if edited else None,
+                   (event.get('previous_message') or {}).get('text'))
+
+    @property
+    def key(self):
+        '''The (type, subtype) by which the message is routed.'''
+        return self.type, self.subtype
+
+    def __repr__(self):
+        return _repr(self)
+
+def _repr(obj):
+    return '{}({})'.format(type(obj).__name__, ', '.join(
+        '{}={!r}'.format(name, getattr(obj, name))
+        for name in obj.__slots__ if getattr(obj, name) is not None))
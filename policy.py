@@ -0,0 +1,130 @@
+''' Decide which messages flipbot flips.
+
+A Policy combines channel and user allow/deny lists, sampling rates,
+per-user cooldowns and per-channel token buckets. Every check is a
+constant time lookup in an in-memory index.
+
+Policies are read from the [POLICY] section of settings.ini:
+
+    [POLICY]
+    # Only flip in these channels (default: everywhere)
+    ALLOW_CHANNELS = C0123 C4567
+    # Never flip in these channels, or messages from these users
+    DENY_CHANNELS = C8901
+    DENY_USERS = U2345
+    # Flip this fraction of messages, overall and in particular channels
+    SAMPLE = 1.0
+    CHANNEL_SAMPLE = C0123:0.25 C4567:0.5
+    # Seconds before a user's messages are flipped again
+    USER_COOLDOWN = 30
+    # Flips per second allowed in a channel, and the burst size
+    CHANNEL_RATE = 0.1
+    CHANNEL_BURST = 5
+'''
+
+import collections
+import random
+import threading
+import time
+
+class TokenBucket:
+    '''Allows up to burst events at once, refilling at rate per second.'''
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        '''Take a token, returning False if none are available.'''
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class Policy:
+    '''Decides whether to flip a message.
+
+    The default policy flips everything. Messages may be checked in
+    several threads at once.
+    '''
+    def __init__(self, allow_channels=(), deny_channels=(), deny_users=(),
+                 sample=1.0, channel_sample=None, user_cooldown=0,
+                 channel_rate=0, channel_burst=1):
+        self.allow_channels = frozenset(allow_channels)
+        self.deny_channels = frozenset(deny_channels)
+        self.deny_users = frozenset(deny_users)
+        self.sample = sample
+        self.channel_sample = dict(channel_sample or {})
+        self.user_cooldown = user_cooldown
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.stats = collections.Counter() # reason -> messages not flipped
+        self._last_flip = {} # user -> time of last flip
+        self._buckets = {}   # channel -> TokenBucket
+        self._lock = threading.Lock() # guards the stats and throttling state
+
+    def inherit(self, old):
+        '''Carry over the throttling state of the policy this replaces.'''
+        self.stats = old.stats
+        self._last_flip = old._last_flip
+        self._lock = old._lock
+        for channel, bucket in old._buckets.items():
+            bucket.rate, bucket.burst = self.channel_rate, self.channel_burst
+            self._buckets[channel] = bucket
+        return self
+
+    def allow(self, channel, user, now=None):
+        '''Return True if a message should be flipped.'''
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            reason = self._refusal(channel, user, now)
+            if reason:
+                self.stats[reason] += 1
+                return False
+            return True
+
+    def _refusal(self, channel, user, now):
+        if channel in self.deny_channels or user in self.deny_users:
+            return 'denied'
+        if self.allow_channels and channel not in self.allow_channels:
+            return 'denied'
+        sample = self.channel_sample.get(channel, self.sample)
+        if sample < 1 and random.random() >= sample:
+            return 'sampled'
+        if self.user_cooldown:
+            last = self._last_flip.get(user)
+            if last is not None and now - last < self.user_cooldown:
+                return 'cooldown'
+        if self.channel_rate:
+            bucket = self._buckets.get(channel)
+            if bucket is None:
+                bucket = self._buckets[channel] = TokenBucket(
+                    self.channel_rate, self.channel_burst, now)
+            if not bucket.take(now):
+                return 'rate'
+        if self.user_cooldown:
+            self._last_flip[user] = now
+        return None
+
+def parse_policy(config):
+    '''Return the Policy in the [POLICY] section of a ConfigParser.'''
+    if not config.has_section('POLICY'):
+        return Policy()
+    section = config['POLICY']
+    return Policy(
+        allow_channels=section.get('ALLOW_CHANNELS', '').split(),
+        deny_channels=section.get('DENY_CHANNELS', '').split(),
+        deny_users=section.get('DENY_USERS', '').split(),
+        sample=section.getfloat('SAMPLE', 1.0),
+        channel_sample={channel: float(rate) for channel, _, rate in
+                        (item.partition(':') for item in
+                         section.get('CHANNEL_SAMPLE', '').split())},
+        user_cooldown=section.getfloat('USER_COOLDOWN', 0),
+        channel_rate=section.getfloat('CHANNEL_RATE', 0),
+        channel_burst=section.getint('CHANNEL_BURST', 1))
@@ -0,0 +1,106 @@
+''' A sampling profiler which can be started in a running bot.
+
+While running, the profiler samples the stack of every thread in the
+process -- the RTM loop, message handlers, image flips -- at a fixed
+interval, then writes the samples as folded stacks, one line per distinct
+stack, which flamegraph.pl and speedscope read. While it isn't running it
+costs nothing: there is no sampling thread and no tracing hook.
+
+Profiling is started by sending the process SIGUSR2, or by an admin
+sending "profile [seconds]" to the bot in a DM. Image flips in worker
+processes are profiled by signalling the workers.
+'''
+
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+class Profiler:
+    '''Samples thread stacks in a background thread, on demand.'''
+    def __init__(self, interval=0.005):
+        self.interval = interval # seconds between samples
+        self.running = False
+        self._lock = threading.Lock()
+
+    def start(self, seconds, path):
+        '''Profile for seconds, then write folded stacks to path.
+
+        Returns False if already profiling.
+        '''
+        with self._lock:
+            if self.running:
+                return False
+            self.running = True
+        threading.Thread(target=self._run, args=(seconds, path),
+                         name='profiler', daemon=True).start()
+        return True
+
+    def _run(self, seconds, path):
+        try:
+            write_folded(sample(seconds, self.interval), path)
+            print('Profile written to', path, file=sys.stderr)
+        except Exception as e:
+            print(e, file=sys.stderr)
+        finally:
+            self.running = False
+
+def sample(seconds, interval=0.005):
+    '''Sample the stacks of the other threads for seconds.
+
+    Returns a Counter of folded stacks: frame names from the thread down,
+    joined by semicolons.
+    '''
+    me = threading.get_ident()
+    stacks = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'thread-%d' % ident))
+            stacks[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+_names = {} # code object -> frame name
+
+def _frame_name(code):
+    name = _names.get(code)
+    if name is None:
+        name = _names[code] = '{}:{}'.format(
+            os.path.basename(code.co_filename),
+            getattr(code, 'co_qualname', code.co_name)).replace(';', ',')
+    return name
+
+def write_folded(stacks, path):
+    '''Write folded stacks, with their sample counts, to path.'''
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write('%s %d\n' % (stack, count))
+    os.replace(tmp, path)
+
+# The profiler for this process
+_profiler = Profiler()
+
+def start(seconds=10, directory='.'):
+    '''Profile this process for seconds, writing the stacks to a new file.
+
+    Returns the path of the file, or None if already profiling.
+    '''
+    path = os.path.join(directory, 'flipbot-{}-{}.folded'.format(
+        os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+    return path if _profiler.start(seconds, path) else None
+
+def install(seconds=10, directory='.', signum=getattr(signal, 'SIGUSR2', None)):
+    '''Start profiling this process whenever it receives signum.'''
+    if signum is not None:
+        signal.signal(signum, lambda signum, frame: start(seconds, directory))
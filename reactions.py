@@ -0,0 +1,97 @@
+''' Add reactions to flipped messages in the background.
+
+A reaction is decoration: the flipped reply is what matters. Reactions
+are queued once the reply has been posted and are added by a background
+thread, which waits while messages are being flipped, so replies are
+never held up behind them. Several events for one message collapse into
+a single reaction, and under load the oldest queued reactions are
+dropped rather than sent late.
+'''
+
+import collections
+import contextlib
+import sys
+import threading
+import time
+
+class ReactionQueue:
+    '''Adds reactions with api_call, one at a time, in a background thread.
+
+    Up to maxlen reactions are queued; messages recently reacted to are
+    remembered, up to maxlen of them, so they aren't reacted to again.
+    '''
+    def __init__(self, api_call, maxlen=1000):
+        self.maxlen = maxlen
+        self.stats = collections.Counter() # outcome -> count
+        self._api_call = api_call
+        self._pending = collections.OrderedDict() # (channel, ts) -> name
+        self._reacted = collections.OrderedDict() # (channel, ts) -> None
+        self._holds = 0
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def add(self, channel, ts, name):
+        '''Queue a reaction to a message.'''
+        key = channel, ts
+        with self._cond:
+            if key in self._pending or key in self._reacted:
+                self.stats['collapsed'] += 1
+                return
+            self._pending[key] = name
+            if len(self._pending) > self.maxlen:
+                self._pending.popitem(last=False)
+                self.stats['dropped'] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def holding(self):
+        '''Hold reactions back while in the context.'''
+        with self._cond:
+            self._holds += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._holds -= 1
+                self._cond.notify_all()
+
+    def flush(self, timeout):
+        '''Add the queued reactions, waiting up to timeout seconds.
+
+        Returns the number of reactions left unsent.
+        '''
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            while self._thread:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return len(self._pending)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not (self._pending and (not self._holds or self._stopping)):
+                    if self._stopping and not self._pending:
+                        self._thread = None
+                        self._cond.notify_all()
+                        return
+                    self._cond.wait()
+                (channel, ts), name = self._pending.popitem(last=False)
+                self._reacted[channel, ts] = None
+                if len(self._reacted) > self.maxlen:
+                    self._reacted.popitem(last=False)
+            try:
+                r = self._api_call('reactions.add', channel=channel,
+                                   timestamp=ts, name=name)
+                self.stats['added' if r.get('ok') else r.get('error', 'failed')] += 1
+            except Exception as e:
+                self.stats['failed'] += 1
+                print(e, file=sys.stderr)
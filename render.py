@@ -0,0 +1,90 @@
+''' Render long text as an upside-down image.
+
+Long pastes of code or logs, flipped a character at a time, become
+unreadable walls of upside-down characters. Rendered as an image and
+turned over, they read like the original, upside down.
+
+Each glyph is drawn once per font into an atlas, and text is drawn by
+pasting glyphs from the atlas, which is much faster than laying out each
+line with ImageDraw.text. The atlas keeps the MAX_GLYPHS most recently
+used glyphs, so text in many scripts can't grow it without bound.
+'''
+
+import functools
+import io
+import math
+import threading
+
+MARGIN = 8 # pixels around the text
+MAX_GLYPHS = 4096 # per atlas
+
+class GlyphAtlas:
+    '''Caches the glyphs of a font, as masks for pasting.'''
+    def __init__(self, font, max_glyphs=MAX_GLYPHS):
+        self.font = font
+        ascent, descent = font.getmetrics()
+        self.line_height = ascent + descent + 2
+        # glyph(c) returns the (mask, advance) of a character
+        self.glyph = functools.lru_cache(maxsize=max_glyphs)(self._draw)
+
+    def _draw(self, c):
+        '''Return the (mask or None if blank, advance) of a character.'''
+        from PIL import Image, ImageDraw
+        advance = self.font.getlength(c)
+        mask = Image.new('L', (math.ceil(advance) + 2, self.line_height), 0)
+        ImageDraw.Draw(mask).text((0, 0), c, fill=255, font=self.font)
+        return mask if mask.getbbox() else None, advance
+
+    def render(self, lines):
+        '''Return an image of lines of text, black on white.'''
+        from PIL import Image
+        glyph = self.glyph
+        width = max((sum(glyph(c)[1] for c in line) for line in lines), default=0)
+        img = Image.new('L', (math.ceil(width) + 2 + 2 * MARGIN,
+                              self.line_height * len(lines) + 2 * MARGIN), 255)
+        y = MARGIN
+        for line in lines:
+            x = MARGIN
+            for c in line:
+                mask, advance = glyph(c)
+                if mask:
+                    img.paste(0, (round(x), y), mask)
+                x += advance
+            y += self.line_height
+        return img
+
+_atlases = {} # (font, size) -> GlyphAtlas, shared by every client
+_atlases_lock = threading.Lock()
+
+def atlas(font=None, size=14):
+    '''Return the glyph atlas of a TrueType font file, or the default font.'''
+    with _atlases_lock:
+        key = font, size
+        if key not in _atlases:
+            from PIL import ImageFont
+            if font:
+                loaded = ImageFont.truetype(font, size)
+            else:
+                try:
+                    loaded = ImageFont.load_default(size)
+                except TypeError: # Pillow < 10.1 has one size
+                    loaded = ImageFont.load_default()
+            _atlases[key] = GlyphAtlas(loaded)
+        return _atlases[key]
+
+def wrap(text, columns=120, max_lines=500):
+    '''Split text into lines of up to columns characters.'''
+    lines = []
+    for line in text.expandtabs(4).splitlines():
+        line = ''.join(c for c in line if c.isprintable())
+        lines.extend(line[i:i + columns] for i in range(0, len(line) or 1, columns))
+    if len(lines) > max_lines:
+        lines[max_lines - 1:] = ['…']
+    return lines
+
+def render_text(text, font=None, size=14, columns=120):
+    '''Return PNG image data of text, upside down.'''
+    img = atlas(font, size).render(wrap(text, columns)).rotate(180)
+    stream = io.BytesIO()
+    img.save(stream, format='PNG', compress_level=1) # fast, and still small
+    return stream.getvalue()
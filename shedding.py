@@ -0,0 +1,49 @@
+''' Shed work when flipbot falls behind.
+
+A flip is only funny while the message is fresh. When messages are being
+handled long after they were posted, the shedding level rises: first
+reactions are dropped, then image flips, then messages are skipped
+altogether.
+'''
+
+import collections
+import threading
+import time
+
+# Shedding levels, and the work shed at each
+NORMAL, REACTIONS, IMAGES, MESSAGES = range(4)
+NAMES = {REACTIONS: 'reactions', IMAGES: 'images', MESSAGES: 'messages'}
+
+class LoadShedder:
+    '''Measures how far behind we are and decides what work to shed.
+
+    thresholds are the lags, in seconds, beyond which reactions, images and
+    messages are shed. A threshold of 0 never sheds that work on its own.
+    Messages may be handled in several threads at once, so each decides
+    with the level measured for it, rather than the latest level.
+    '''
+    def __init__(self, thresholds=(60, 300, 0)):
+        self.thresholds = thresholds
+        self.level = NORMAL # for the latest message, exposed as a metric
+        self.lag = 0.0      # seconds, for the latest message
+        self.shed = collections.Counter() # work name -> count shed
+        self._lock = threading.Lock()
+
+    def measure(self, ts, now=None):
+        '''Update the lag and shedding level from a message ts.'''
+        now = time.time() if now is None else now
+        self.lag = lag = now - float(ts)
+        level = NORMAL
+        for work, threshold in enumerate(self.thresholds, REACTIONS):
+            if threshold and lag > threshold:
+                level = work
+        self.level = level
+        return level
+
+    def allow(self, work, level):
+        '''Return True unless work is shed at a level returned by measure.'''
+        if level >= work:
+            with self._lock:
+                self.shed[NAMES[work]] += 1
+            return False
+        return True
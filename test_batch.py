@@ -0,0 +1,70 @@
+''' Batch mode tests '''
+
+import io
+
+from PIL import Image
+
+import batch
+
+def test_flip_text_stream():
+    out = io.StringIO()
+    stats = batch.flip_text_stream(['abc\n', 'go :+1:\n'], out, jobs=1)
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 2
+    assert lines[0] == 'ɔqɐ'
+    assert lines[1].endswith('oƃ')
+    assert stats.items == 2
+    assert stats.errors == 0
+
+def test_flip_text_stream_parallel(monkeypatch):
+    lines = ['line %d\n' % i for i in range(100)]
+    serial, parallel = io.StringIO(), io.StringIO()
+    batch.flip_text_stream(lines, serial)
+    monkeypatch.setattr(batch.flipbot, 'POOL_MIN_TEXTS', 50)
+    batch.flip_text_stream(lines, parallel, jobs=2, chunksize=7)
+    assert serial.getvalue() == parallel.getvalue()
+
+def test_small_input_not_pooled(monkeypatch):
+    import multiprocessing
+    monkeypatch.setattr(multiprocessing, 'Pool', None) # would fail if used
+    out = io.StringIO()
+    batch.flip_text_stream(['abc\n'] * 100, out, jobs=4)
+    assert out.getvalue() == 'ɔqɐ\n' * 100
+
+def test_read_ahead_bounded():
+    read = []
+
+    def items():
+        for i in range(1000):
+            read.append(i)
+            yield i
+    results = batch._imap(abs, items(), jobs=2)
+    assert next(results) == 0
+    assert len(read) <= 2 * batch.WINDOW + 1
+    assert list(results) == list(range(1, 1000))
+
+def test_stdin_left_open(tmp_path, monkeypatch):
+    import argparse
+    import sys
+    stdin = io.StringIO('abc\n')
+    monkeypatch.setattr(sys, 'stdin', stdin)
+    batch.main(argparse.Namespace(out=str(tmp_path), images=None, text='-', jobs=1))
+    assert not stdin.closed
+    assert (tmp_path / 'stdin.txt').read_text(encoding='utf-8') == 'ɔqɐ\n'
+
+def test_flip_image_dir(tmp_path):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    src.mkdir()
+    dst.mkdir()
+    img = Image.new('RGB', (2, 1))
+    img.putpixel((0, 0), (255, 0, 0))
+    img.save(str(src / 'red.png'))
+    (src / 'notes.txt').write_text('not an image')
+    (src / 'broken.png').write_bytes(b'not a png')
+
+    stats = batch.flip_image_dir(str(src), str(dst), jobs=2)
+    assert stats.items == 1
+    assert stats.errors == 1
+    flipped = Image.open(str(dst / 'red.png'))
+    assert flipped.getpixel((1, 0)) == (255, 0, 0)
+    assert not (dst / 'notes.txt').exists()
@@ -0,0 +1,63 @@
+''' Configuration tests '''
+
+import time
+
+import pytest
+
+import config
+
+def test_defaults():
+    c = config.Config()
+    assert c.token is None
+    assert c.verbose is False
+    assert c.dedup_window == 600
+    assert c.policy.allow('C1', 'U1')
+    with pytest.raises(TypeError):
+        config.Config(no_such_setting=1)
+
+def test_load(tmp_path):
+    path = tmp_path / 'settings.ini'
+    path.write_text('[SETTINGS]\n'
+                    'TOKEN = xoxb-file\n'
+                    'USER = UBOT\n'
+                    'VERBOSE = yes\n'
+                    'MAX_REPLIES = 50\n'
+                    'ADMIN_USERS = U1 U2\n'
+                    '[POLICY]\n'
+                    'DENY_USERS = U9\n')
+    c = config.load(str(path), environ={'FLIPBOT_TOKEN': 'xoxb-env',
+                                        'FLIPBOT_DEDUP_WINDOW': '60'},
+                    threaded=True)
+    assert c.token == 'xoxb-env'
+    assert c.user == 'UBOT'
+    assert c.verbose is True
+    assert c.max_replies == 50
+    assert c.admin_users == {'U1', 'U2'}
+    assert c.dedup_window == 60.0
+    assert c.threaded is True
+    assert not c.policy.allow('C1', 'U9')
+    assert 'xoxb' not in repr(c)
+
+def test_load_invalid(tmp_path):
+    path = tmp_path / 'settings.ini'
+    path.write_text('[SETTINGS]\nVERBOSE = perhaps\n')
+    with pytest.raises(ValueError):
+        config.load(str(path), environ={})
+
+def test_load_missing_file(tmp_path):
+    c = config.load(str(tmp_path / 'missing.ini'), environ={})
+    assert c.token is None
+
+def test_watcher(tmp_path):
+    path = tmp_path / 'settings.ini'
+    path.write_text('[SETTINGS]\nVERBOSE = no\n')
+    changes = []
+    watcher = config.Watcher(str(path), changes.append, interval=0.01,
+                             user='UBOT')
+    path.write_text('[SETTINGS]\nVERBOSE = yes\n')
+    deadline = time.time() + 5
+    while not changes and time.time() < deadline:
+        time.sleep(0.01)
+    watcher.stop()
+    assert changes[0].verbose is True
+    assert changes[0].user == 'UBOT'
@@ -0,0 +1,89 @@
+''' Deduplication tests '''
+
+import multiprocessing
+
+from dedup import Deduplicator, SharedIndex
+
+def test_duplicates_dropped():
+    d = Deduplicator()
+    assert not d.seen('C1', '1.1', now=0)
+    assert not d.seen('C2', '1.1', now=0)
+    assert d.seen('C1', '1.1', now=1)
+    assert d.dropped == 1
+
+def test_window_and_bound():
+    d = Deduplicator(window=10, maxlen=3)
+    assert not d.seen('C', '1', now=0)
+    assert not d.seen('C', '1', now=11)
+    for ts in '234':
+        d.seen('C', ts, now=12)
+    assert len(d) == 3
+    assert not d.seen('C', '1', now=12)
+
+def test_persisted(tmp_path):
+    path = str(tmp_path / 'seen.log')
+    d = Deduplicator(path=path)
+    d.seen('C', '1')
+    d.done('C', '1')
+    d.close()
+    with open(path, 'a') as f:
+        f.write('["C", "2"') # partial write
+    d = Deduplicator(path=path)
+    assert d.seen('C', '1')
+    assert not d.seen('C', '2')
+    d.close()
+
+def test_log_compacted(tmp_path):
+    path = str(tmp_path / 'seen.log')
+    d = Deduplicator(maxlen=10, path=path)
+    for ts in range(100):
+        d.seen('C', str(ts))
+        d.done('C', str(ts))
+    with open(path) as f:
+        assert len(f.readlines()) <= 2 * 10 + 1
+    d.close()
+    d = Deduplicator(maxlen=10, path=path)
+    assert d.seen('C', '99')
+    d.close()
+
+def test_unfinished_not_persisted(tmp_path):
+    path = str(tmp_path / 'seen.log')
+    d = Deduplicator(path=path)
+    d.seen('C', '1')
+    d.done('C', '1')
+    d.seen('C', '2') # the process dies while handling this
+    d.close()
+    d = Deduplicator(path=path)
+    assert d.seen('C', '1')
+    assert not d.seen('C', '2')
+    d.close()
+
+def test_forgotten():
+    d = Deduplicator()
+    d.seen('C', '1')
+    d.forget('C', '1')
+    assert not d.seen('C', '1')
+
+def _seen_in_child(shared, result):
+    d = Deduplicator(shared=shared)
+    result.value = d.seen('C', '1')
+
+def test_seen_by_another_process():
+    shared = SharedIndex(maxlen=10)
+    d = Deduplicator(shared=shared)
+    assert not d.seen('C', '1')
+    result = multiprocessing.Value('b', False)
+    child = multiprocessing.Process(target=_seen_in_child, args=(shared, result))
+    child.start()
+    child.join()
+    assert result.value
+    d.forget('C', '1')
+    assert not Deduplicator(shared=shared).seen('C', '1')
+
+def test_shared_index_bound():
+    shared = SharedIndex(maxlen=3)
+    for ts in '1234':
+        assert not shared.add(('C', ts), 0, 10)
+    assert shared.add(('C', '4'), 1, 10)
+    assert not shared.add(('C', '1'), 1, 10)
+    assert not shared.add(('C', '4'), 20, 10) # expired
@@ -0,0 +1,101 @@
+''' Events API receiver tests '''
+
+import asyncio
+import json
+import threading
+import time
+
+import events
+
+SECRET = '8f742231b10e8888abcd99yyyzzz85a5'
+
+def request(receiver, payload, secret=SECRET, timestamp=None):
+    body = json.dumps(payload).encode()
+    timestamp = str(int(time.time())) if timestamp is None else timestamp
+    headers = {'x-slack-request-timestamp': timestamp,
+               'x-slack-signature': events.signature(secret, timestamp, body)}
+    return receiver.dispatch('POST', headers, body)
+
+def test_verify_signature():
+    # Example from https://api.slack.com/authentication/verifying-requests-from-slack
+    body = (b'token=xyzz0WbapA4vBCDEFasx0q6G&team_id=T1DC2JH3J&team_domain=testteamnow'
+            b'&channel_id=G8PSS9T3V&channel_name=foobar&user_id=U2CERLKJA'
+            b'&user_name=roadrunner&command=%2Fwebhook-collect&text='
+            b'&response_url=https%3A%2F%2Fhooks.slack.com%2Fcommands%2FT1DC2JH3J'
+            b'%2F397700885554%2F96rGlfmibIGlgcZRskXaIFfN&trigger_id=398738663015.'
+            b'47445629121.803a0bc887a14d10d2c447fce8b6703c')
+    sig = 'v0=a2114d57b48eac39b9ad189dd8316235a7b4a8d21a10bd27519666489c69b503'
+    assert events.verify_signature(SECRET, '1531420618', body, sig, now=1531420618)
+    assert not events.verify_signature(SECRET, '1531420618', body, sig, now=1531429999)
+    assert not events.verify_signature(SECRET, '1531420618', body + b'x', sig,
+                                       now=1531420618)
+    assert not events.verify_signature(SECRET, None, body, None)
+
+def test_dispatch():
+    handled = []
+    receiver = events.EventReceiver(handled.append, SECRET, workers=1)
+    assert request(receiver, {'type': 'url_verification', 'challenge': 'abc'}) == \
+        (200, 'text/plain', b'abc')
+    assert request(receiver, events.make_event(1), secret='wrong')[0] == 401
+    assert request(receiver, events.make_event(1))[0] == 200
+    receiver.join()
+    assert handled[0]['text'].startswith('Load test message 1')
+    assert receiver.stats['bad_signature'] == 1
+
+def test_events_parsed_as_queued():
+    handled = []
+    receiver = events.EventReceiver(handled.append, SECRET, workers=1,
+                                    parse=lambda event: event['text'])
+    request(receiver, events.make_event(2))
+    receiver.join()
+    assert handled == ['Load test message 2 :smile:']
+
+def test_serve_and_load():
+    handled = []
+    receiver = events.EventReceiver(handled.append, SECRET)
+
+    async def run():
+        server = await asyncio.start_server(receiver.serve_connection,
+                                            '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await events.load('127.0.0.1', port, SECRET,
+                                     count=50, connections=5)
+
+    latencies = asyncio.run(run())
+    receiver.join()
+    assert [status for status, _ in latencies] == [200] * 50
+    assert len(handled) == 50
+
+def test_drain():
+    release = threading.Event()
+    receiver = events.EventReceiver(lambda event: release.wait(), SECRET, workers=1)
+    for n in range(3):
+        request(receiver, events.make_event(n))
+    assert receiver.drain(0.01) == 3
+    release.set()
+    assert receiver.drain(5) == 0
+
+def test_bad_events_acknowledged():
+    def parse(event):
+        return event['text'].upper()
+    receiver = events.EventReceiver(lambda event: None, SECRET, workers=1,
+                                    parse=parse)
+    assert request(receiver, {'type': 'event_callback'})[0] == 200
+    assert request(receiver, {'type': 'event_callback', 'event': {}})[0] == 200
+    assert request(receiver, ['not', 'an', 'object'])[0] == 400
+    assert receiver.stats['bad_event'] == 3
+    assert request(receiver, events.make_event(3))[0] == 200
+    assert receiver.stats['queued'] == 1
+
+def test_finished_after_drain():
+    import os
+    import signal
+    calls = []
+
+    def make_handle(instance):
+        return calls.append, lambda: calls.append('finished')
+    threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGTERM)).start()
+    events._serve_process(make_handle, None, SECRET, '127.0.0.1', 0, False,
+                          1, 10, 1, None, None)
+    assert calls == ['finished']
@@ -0,0 +1,68 @@
+''' JSON codec tests '''
+
+import json
+
+import pytest
+
+import fastjson
+
+def test_codecs_agree():
+    doc = {'type': 'message', 'text': 'héllo \U0001f600 "quoted"', 'n': [1, 2.5, None, True]}
+    for name in fastjson.PARSERS:
+        try:
+            codec = fastjson.Codec(name)
+        except ImportError:
+            continue
+        assert codec.name == name
+        assert codec.loads(json.dumps(doc)) == doc
+        assert codec.loads(json.dumps(doc).encode()) == doc
+        assert json.loads(codec.dumps(doc)) == doc
+        assert isinstance(codec.dumps(doc), str)
+        with pytest.raises(ValueError):
+            codec.loads('{"truncated":')
+
+def test_fastest_installed(monkeypatch):
+    def missing():
+        raise ImportError
+    monkeypatch.setitem(fastjson.PARSERS, 'orjson', missing)
+    monkeypatch.setitem(fastjson.PARSERS, 'ujson', missing)
+    assert fastjson.Codec().name == 'json'
+    with pytest.raises(ImportError):
+        fastjson.Codec('orjson')
+    with pytest.raises(ValueError):
+        fastjson.Codec('yaml')
+
+def test_options_use_stdlib():
+    codec = fastjson.Codec()
+    assert codec.dumps({'a': 1}, indent=1) == '{\n "a": 1\n}'
+
+def test_install():
+    import slackclient.client
+    codec = fastjson.Codec()
+    try:
+        fastjson.install(codec)
+        assert slackclient.client.json is codec
+    finally:
+        fastjson.install(json)
+
+def test_used_once(monkeypatch, capsys):
+    import slackclient.client
+    monkeypatch.setattr(fastjson, '_installed', None)
+    try:
+        codec = fastjson.use('json')
+        assert fastjson.use() is codec
+        assert fastjson.use('json') is codec
+        assert slackclient.client.json is codec
+        try:
+            fastjson.Codec('orjson')
+        except ImportError:
+            return
+        assert fastjson.use('orjson') is codec
+        assert 'orjson ignored' in capsys.readouterr().err
+    finally:
+        fastjson.install(json)
+
+def test_receiver_parser():
+    import events
+    assert events.EventReceiver(None, 'secret', workers=0,
+                                json_parser='json')._codec.name == 'json'
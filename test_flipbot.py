@@ -1,6 +1,20 @@
 ''' Flipbot tests '''
 
+import collections
+import io
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+import slackclient
+
+import config
 import flipbot
+from message import Message
+from policy import Policy
 
 def test_markup_matcher():
     match = flipbot.markup_re.match
@@ -64,3 +78,466 @@ def test_flip_markedup_text():
                     '<E(http://example.com)|F(example)>F(go to )')
     assert (flipper('<!rotate><@USER1><@NOT_A_USER>', handler) == 
                     '<E(@NOT_A_USER)><E(@USER1)|F(thomas)><E(!rotate)>')
+
+def test_flip_many(monkeypatch):
+    flipper = flipbot.FlipMarkedupText({'@USER1': 'thomas'})
+    texts = ['I :+1: this!', 'go to <http://example.com|example>',
+             '<!here> <@USER1> &lt;3', '', 'two\nlines', 'straße']
+    expected = [flipbot.flip_markedup_text(t, flipper) for t in texts]
+    assert flipbot.flip_many(texts, flipper) == expected
+    monkeypatch.setattr(flipbot, 'POOL_MIN_TEXTS', 5)
+    assert flipbot.flip_many(texts * 3, flipper, jobs=2, chunksize=4) == expected * 3
+    assert flipbot.flip_many([], flipper) == []
+    # Texts which can't be joined, and other flippers, are flipped one by one
+    assert flipbot.flip_many(['a\x00b'], flipper) == ['q\x00ɐ']
+    handler = MarkupHandler({})
+    assert flipbot.flip_many(['I :+1: this!'], handler) == ['F( this!)J(:+1:)F(I )']
+
+def test_flipper_pickles():
+    import pickle
+    flipper = pickle.loads(pickle.dumps(flipbot.FlipMarkedupText({'@U1': 'tom'})))
+    assert flipper.users == {'@U1': 'tom'}
+    with pytest.raises(TypeError):
+        flipper.users['@U2'] = 'ann'
+
+def test_import_is_lightweight(tmp_path):
+    # Importing flipbot must not need settings.ini or load heavy libraries.
+    code = ('import sys, flipbot; '
+            'print(*[m for m in ("PIL", "requests", "slackclient", "upsidedown") '
+            'if m in sys.modules])')
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(flipbot.__file__)))
+    out = subprocess.run([sys.executable, '-c', code], cwd=str(tmp_path), env=env,
+                         check=True, stdout=subprocess.PIPE,
+                         universal_newlines=True).stdout
+    assert out.strip() == ''
+
+
+class FakeSlack:
+    '''Stands in for slackclient.SlackClient, recording API calls.'''
+    def __init__(self, token):
+        self.calls = []
+        self.members = [{'id': 'USER1', 'name': 'thomas'}]
+        self.connects = []  # results of successive rtm_connect calls
+        self.frames = []    # frames, or exceptions, for successive rtm_reads
+        self.history = {}   # channel -> messages
+
+    def rtm_connect(self):
+        return self.connects.pop(0) if self.connects else True
+
+    def rtm_read(self):
+        frame = self.frames.pop(0) if self.frames else []
+        if isinstance(frame, Exception):
+            raise frame
+        return frame
+
+    def api_call(self, method, **kwargs):
+        self.calls.append((method, kwargs))
+        if method == 'users.list':
+            return {'ok': True, 'members': list(self.members)}
+        if method == 'users.conversations':
+            return {'ok': True, 'channels': [{'id': c} for c in self.history]}
+        if method == 'conversations.history':
+            oldest = float(kwargs['oldest'])
+            return {'ok': True, 'has_more': False,
+                    'messages': [dict(m) for m in self.history[kwargs['channel']]
+                                 if float(m['ts']) > oldest]}
+        if method == 'chat.postMessage':
+            return {'ok': True, 'ts': 'R%d' % len(self.calls)}
+        if method == 'files.upload':
+            return {'ok': True, 'file': {'id': 'F%d' % len(self.calls)}}
+        return {'ok': True}
+
+    def posted(self):
+        return [kw for method, kw in self.calls if method == 'chat.postMessage']
+
+def settings(**kwargs):
+    return config.Config(token='xoxb-token', user='UBOT', **kwargs)
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(slackclient, 'SlackClient', FakeSlack)
+    return flipbot.FlipClient(settings())
+
+def handle(client, event):
+    client._handle(Message.parse(event))
+
+def test_unreadable_event_skipped(client):
+    client._client.frames = [[
+        {'type': 'message', 'channel': 'C1', 'ts': '1.0', 'text': 'hi',
+         'file': 'not an object'},
+        {'type': 'message', 'channel': 'C1', 'ts': '2.0', 'text': 'there'}]]
+    assert [msg.text for msg in client._read()] == ['there']
+    assert client.connected
+
+def test_user_snapshot():
+    users = {'@USER1': 'thomas'}
+    flipper = flipbot.FlipMarkedupText(users)
+    users['@USER1'] = 'changed'
+    assert flipper.users['@USER1'] == 'thomas'
+    with pytest.raises(TypeError):
+        flipper.users['@USER2'] = 'new'
+
+def test_user_rename_reaches_flipper(client):
+    flip = lambda: flipbot.flip_markedup_text('<@USER1>', client._flipper)
+    before = flip()
+    client._client.members = [{'id': 'USER1', 'name': 'tom'}]
+    client._client.frames = [[
+        {'type': 'user_change',
+         'user': {'id': 'USER1', 'name': 'tom', 'profile': {'real_name': 'Tom'}}},
+        {'type': 'message', 'channel': 'C1', 'ts': '1.0', 'text': 'hi'}]]
+    msgs = client._read()
+    assert [msg.user for msg in msgs] == ['USER1', None]
+    client.flip(msgs)
+    assert len(client._client.posted()) == 1
+    with client._users_refreshing: # wait for the background refresh
+        pass
+    assert client._flipper.users['@USER1'] == 'tom'
+    assert flip() != before
+
+def test_concurrent_flips_during_refresh():
+    flipper = flipbot.FlipMarkedupText({'@U': 'a'})
+    stop = threading.Event()
+    errors = []
+    def flip():
+        while not stop.is_set():
+            out = flipbot.flip_markedup_text('<@U>', flipper)
+            if out not in ('<@U|ɐ>', '<@U|q>'):
+                errors.append(out)
+    threads = [threading.Thread(target=flip) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for i in range(1000):
+        flipper.users = {'@U': 'ab'[i % 2]}
+    stop.set()
+    for t in threads:
+        t.join()
+    assert not errors
+
+def test_replayed_message_flipped_once(client):
+    msg = {'type': 'message', 'channel': 'C1', 'ts': '1.1', 'text': 'hi'}
+    handle(client, msg)
+    handle(client, dict(msg))
+    assert len(client._client.posted()) == 1
+    assert client._dedup.dropped == 1
+
+def test_failed_message_retried(client, capsys):
+    msg = {'type': 'message', 'channel': 'C1', 'ts': '1.1', 'text': 'hi'}
+    api_call = client._api_call
+
+    def fail(method, **kwargs):
+        raise ConnectionError('socket closed')
+    client._api_call = fail
+    handle(client, msg)
+    client._api_call = api_call
+    handle(client, dict(msg))
+    assert len(client._client.posted()) == 1
+    assert client._dedup.dropped == 0
+
+def test_retry_to_another_process(monkeypatch, tmp_path):
+    from dedup import SharedIndex
+    monkeypatch.setattr(slackclient, 'SlackClient', FakeSlack)
+    dedup_file = str(tmp_path / 'seen.log')
+    shared = SharedIndex()
+    first, _ = flipbot._client_handler(settings(dedup_file=dedup_file), 0, shared)
+    second, _ = flipbot._client_handler(settings(dedup_file=dedup_file), 1, shared)
+    msg = {'type': 'message', 'channel': 'C1', 'ts': '1.1', 'text': 'hi'}
+    first(Message.parse(msg))
+    second(Message.parse(dict(msg))) # slack's retry
+    assert len(first.__self__._client.posted()) == 1
+    assert not second.__self__._client.posted()
+    assert second.__self__._dedup.dropped == 1
+    assert os.path.exists(dedup_file + '.0') and os.path.exists(dedup_file + '.1')
+
+def test_replies_from_several_threads(monkeypatch):
+    monkeypatch.setattr(slackclient, 'SlackClient', FakeSlack)
+    client = flipbot.FlipClient(settings(max_replies=10), connect=False)
+
+    def flip(n):
+        for i in range(200):
+            handle(client, {'type': 'message', 'channel': 'C%d' % n,
+                            'ts': '%d.1' % i, 'text': 'hi'})
+    threads = [threading.Thread(target=flip, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(client._client.posted()) == 800
+    assert len(client._replies) == 10
+
+def test_reconnect_delays():
+    delays = flipbot.reconnect_delays(1, 8)
+    first = [next(delays) for _ in range(6)]
+    assert 0.5 <= first[0] <= 1.5
+    assert all(d <= 8 for d in first)
+    assert first[-1] >= 4
+
+def test_reconnect_and_catch_up(client):
+    client.configure(settings(reconnect_initial=0.001, reconnect_max=0.001))
+    now = flipbot.time.time()
+    ts = lambda age: '%.6f' % (now - age)
+    slack = client._client
+    slack.frames = [
+        [{'type': 'message', 'channel': 'C1', 'ts': ts(100), 'text': 'one'}],
+        ConnectionError('socket closed'),
+        [{'type': 'message', 'channel': 'C1', 'ts': ts(10), 'text': 'live'}],
+    ]
+    slack.connects = [False, False, True]
+    slack.history = {
+        'C1': [{'type': 'message', 'ts': ts(100), 'text': 'one'},
+               {'type': 'message', 'ts': ts(50), 'text': 'missed'}],
+        'C2': [{'type': 'message', 'ts': ts(40), 'text': 'also missed'}],
+    }
+    for _ in range(3):
+        client.flip(client._read())
+    texts = [p['text'] for p in slack.posted()]
+    assert texts == [flipbot.flip_markedup_text(t, client._flipper)
+                     for t in ('one', 'missed', 'also missed', 'live')]
+    assert not slack.connects
+
+def test_stop_while_reconnecting(client):
+    client._client.connects = [False] * 1000
+    client._client.frames = [ConnectionError('socket closed')]
+    client.configure(settings(reconnect_initial=60, reconnect_max=60))
+    threading.Timer(0.05, client.stop).start()
+    start = time.monotonic()
+    assert client._read() == []
+    assert time.monotonic() - start < 5
+    assert len(client._client.connects) == 999
+
+def test_catch_up_drains(client):
+    now = flipbot.time.time()
+    client._last_ts = '%.6f' % (now - 100)
+    client._client.history = {'C1': [
+        {'type': 'message', 'ts': '%.6f' % (now - 50 + i), 'text': 'missed'}
+        for i in range(3)]}
+    client.stop()
+    client._drain_deadline = time.monotonic() - 1 # passed
+    client._catch_up()
+    assert client._client.posted() == []
+
+def test_catch_up_age_cutoff(client):
+    now = flipbot.time.time()
+    client.configure(settings(max_backlog_age=60))
+    client._last_ts = '%.6f' % (now - 1000)
+    client._client.history = {'C1': [
+        {'type': 'message', 'ts': '%.6f' % (now - 500), 'text': 'stale'},
+        {'type': 'message', 'ts': '%.6f' % (now - 30), 'text': 'fresh'}]}
+    client._catch_up()
+    assert len(client._client.posted()) == 1
+
+def test_routing(client):
+    handle(client, {'type': 'presence_change', 'user': 'USER1'})
+    handle(client, {'type': 'user_typing', 'channel': 'C1'})
+    handle(client, {'type': 'user_typing', 'channel': 'C1'})
+    handle(client, {'type': 'message', 'subtype': 'bot_message',
+                    'channel': 'C1', 'ts': '1.0', 'text': 'beep'})
+    handle(client, {'type': 'message', 'subtype': '',
+                    'channel': 'C1', 'ts': '2.0', 'text': 'hello'})
+    assert client.filtered == {('presence_change', None): 1,
+                               ('user_typing', None): 2,
+                               ('message', 'bot_message'): 1}
+    assert client.routed == {('message', None): 1}
+    assert len(client._client.posted()) == 1
+
+def test_text_only_routes(monkeypatch):
+    monkeypatch.setattr(slackclient, 'SlackClient', FakeSlack)
+    client = flipbot.FlipClient(settings(text_only=True))
+    handle(client, {'type': 'message', 'subtype': 'file_share', 'channel': 'C1',
+                    'ts': '1.0', 'file': {'mimetype': 'image/png'}})
+    assert client.filtered == {('message', 'file_share'): 1}
+
+def test_policy_applied(client):
+    client.configure(settings(policy=Policy(deny_channels=['C2'])))
+    for channel in 'C1', 'C2':
+        handle(client, {'type': 'message', 'channel': channel, 'ts': '1.0',
+                        'user': 'USER1', 'text': 'hi'})
+    assert [p['channel'] for p in client._client.posted()] == ['C1']
+
+def test_thread_replies(client):
+    handle(client, {'type': 'message', 'channel': 'C1', 'ts': '2.0',
+                    'thread_ts': '1.0', 'text': 'in a thread'})
+    handle(client, {'type': 'message', 'channel': 'C1', 'ts': '3.0',
+                    'text': 'in the channel'})
+    client.configure(settings(threaded=True))
+    handle(client, {'type': 'message', 'channel': 'C1', 'ts': '4.0',
+                    'text': 'threaded mode'})
+    assert [p.get('thread_ts') for p in client._client.posted()] == \
+        ['1.0', None, '4.0']
+
+def test_edit_updates_reply(client):
+    slack = client._client
+    client.configure(settings(max_replies=1))
+    for ts in '1.0', '2.0':
+        handle(client, {'type': 'message', 'channel': 'C1', 'ts': ts,
+                        'user': 'USER1', 'text': 'helo'})
+    def edit(ts, text, event_ts, user='USER1'):
+        handle(client, {'type': 'message', 'subtype': 'message_changed',
+                        'channel': 'C1', 'ts': event_ts,
+                        'message': {'ts': ts, 'user': user, 'text': text},
+                        'previous_message': {'ts': ts, 'text': 'helo'}})
+    edit('2.0', 'hello', '5.0')
+    edit('2.0', 'helo', '6.0')            # unfurl, text unchanged
+    edit('1.0', 'hello', '7.0')           # reply forgotten
+    edit('2.0', 'hello', '8.0', 'UBOT')   # our own update
+    updates = [kw for method, kw in slack.calls if method == 'chat.update']
+    assert len(updates) == 1
+    assert updates[0]['text'] == flipbot.flip_markedup_text('hello', client._flipper)
+    assert len(slack.posted()) == 2
+    assert updates[0]['ts'] == client._replies['C1', '2.0']
+
+def test_configure_keeps_connection_settings(client):
+    new = config.Config(token='other', user='UOTHER', verbose=True)
+    client.configure(new)
+    assert client.config.verbose
+    assert (client.config.token, client.config.user) == ('xoxb-token', 'UBOT')
+    assert (new.token, new.user) == ('other', 'UOTHER')
+
+def test_graceful_shutdown(monkeypatch, tmp_path):
+    monkeypatch.setattr(slackclient, 'SlackClient', FakeSlack)
+    state = str(tmp_path / 'state.json')
+    client = flipbot.FlipClient(settings(state_file=state))
+    slack = client._client
+    slack.frames = [[{'type': 'message', 'channel': 'C1', 'ts': '1.0', 'text': 'a'}],
+                    [{'type': 'message', 'channel': 'C1', 'ts': '2.0', 'text': 'b'}]]
+    # Stop as the first reply is posted: the buffered message is drained.
+    api_call = slack.api_call
+    def stop_on_post(method, **kwargs):
+        if method == 'chat.postMessage':
+            client.stop()
+        return api_call(method, **kwargs)
+    slack.api_call = client._api_call = stop_on_post
+    client.run()
+    assert len(slack.posted()) == 2
+    with open(state) as f:
+        assert f.read() == '{"last_ts": "2.0"}'
+
+    # The next run catches up from the saved ts.
+    client = flipbot.FlipClient(settings(state_file=state))
+    assert client._last_ts == '2.0'
+
+def test_drain_deadline(client):
+    client.configure(settings(drain_timeout=0))
+    client._client.frames = [[{'type': 'message', 'channel': 'C1', 'ts': '1.0',
+                               'text': 'a'}]]
+    client.stop()
+    client.run()
+    assert not client._client.posted()
+
+def test_load_shedding(client):
+    client.configure(settings(shed_reactions_lag=10, max_message_age=60))
+    now = flipbot.time.time()
+    for age in 1, 30, 90:
+        handle(client, {'type': 'message', 'channel': 'C1',
+                        'ts': '%.6f' % (now - age), 'text': 'hi'})
+    client.reactions.flush(5)
+    methods = collections.Counter(method for method, _ in client._client.calls)
+    assert methods['chat.postMessage'] == 2
+    assert methods['reactions.add'] == 1
+    assert client.shedder.level == flipbot.shedding.MESSAGES
+    assert client.shedder.shed == {'reactions': 1, 'messages': 1}
+
+def test_admin_profile_command(client, monkeypatch):
+    started = []
+    monkeypatch.setattr(flipbot.profiler, 'start',
+                        lambda seconds, directory: started.append(seconds) or 'out.folded')
+    client.configure(settings(admin_users=frozenset(['UADMIN'])))
+    handle(client, {'type': 'message', 'channel': 'D1', 'ts': '1.0',
+                    'user': 'UADMIN', 'text': 'profile 30'})
+    handle(client, {'type': 'message', 'channel': 'D2', 'ts': '2.0',
+                    'user': 'USER1', 'text': 'profile'})
+    assert started == [30]
+    texts = [p['text'] for p in client._client.posted()]
+    assert texts[0] == 'Profiling for 30s, writing out.folded'
+    assert texts[1] == flipbot.flip_markedup_text('profile', client._flipper)
+
+@pytest.mark.parametrize('seconds', ['abc', 'nan', '0', '-5'])
+def test_admin_profile_bad_seconds(client, monkeypatch, seconds):
+    started = []
+    monkeypatch.setattr(flipbot.profiler, 'start',
+                        lambda seconds, directory: started.append(seconds) or 'out.folded')
+    client.configure(settings(admin_users=frozenset(['UADMIN'])))
+    handle(client, {'type': 'message', 'channel': 'D1', 'ts': '1.0',
+                    'user': 'UADMIN', 'text': 'profile ' + seconds})
+    assert not started
+    assert client._client.posted()[0]['text'].startswith('Usage: profile [seconds]')
+
+def test_reactions_follow_replies(client):
+    slack = client._client
+    api_call = slack.api_call
+    def fail_second_post(method, **kwargs):
+        if method == 'chat.postMessage' and kwargs['text'] == flipbot.flip_markedup_text(
+                'fails', client._flipper):
+            return {'ok': False, 'error': 'rate_limited'}
+        return api_call(method, **kwargs)
+    client._api_call = client.reactions._api_call = fail_second_post
+    now = '%.6f' % flipbot.time.time()
+    msg = {'type': 'message', 'channel': 'C1', 'ts': now, 'text': 'hi'}
+    with client.reactions.holding():
+        handle(client, msg)
+        handle(client, dict(msg, subtype='thread_broadcast'))
+        handle(client, {'type': 'message', 'channel': 'C1', 'ts': now + '1',
+                        'text': 'fails'})
+        assert not [m for m, _ in slack.calls if m == 'reactions.add']
+    assert client.reactions.flush(5) == 0
+    reactions = [kw for m, kw in slack.calls if m == 'reactions.add']
+    assert [(r['channel'], r['timestamp']) for r in reactions] == [('C1', now)]
+    assert reactions[0]['name'] in flipbot.emoji.WRONG_WAY_UP
+
+class FakeResponse:
+    def __init__(self, content):
+        self.status_code = 200 if content else 404
+        self.content = content
+
+def png(width, height):
+    from PIL import Image
+    stream = io.BytesIO()
+    Image.new('RGB', (width, height)).save(stream, format='PNG')
+    return stream.getvalue()
+
+def test_image_preview(client, monkeypatch):
+    import requests
+    images = {'https://full': png(40, 30), 'https://thumb_16': png(16, 12)}
+    downloads = []
+    def get(url, headers):
+        downloads.append(url)
+        return FakeResponse(images.get(url))
+    monkeypatch.setattr(requests, 'get', get)
+    client.configure(settings(image_preview=True, preview_size=20))
+    handle(client, {'type': 'message', 'subtype': 'file_share', 'channel': 'C1',
+                    'ts': '%.6f' % flipbot.time.time(),
+                    'file': {'name': 'cat.png', 'mimetype': 'image/png',
+                             'url_private_download': 'https://full',
+                             'original_w': 40, 'original_h': 30,
+                             'thumb_16': 'https://thumb_16',
+                             'thumb_64': 'https://thumb_64'}})
+    # The preview is posted straight away, and replaced in the background.
+    assert downloads[0] == 'https://thumb_16'
+    client.save_state()
+    assert downloads == ['https://thumb_16', 'https://full']
+    calls = client._client.calls
+    uploads = [i + 1 for i, (method, _) in enumerate(calls) if method == 'files.upload']
+    deletes = [kw['file'] for method, kw in calls if method == 'files.delete']
+    assert len(uploads) == 2
+    assert deletes == ['F%d' % uploads[0]] # the preview
+
+def test_plain_text():
+    flipper = flipbot.FlipMarkedupText({'@U1': 'tom'})
+    assert flipbot.plain_text('hi <@U1>, see <#C1|general> and '
+                              '<http://x.org|this> :+1: &lt;3', flipper) == \
+        'hi @tom, see #general and this :+1: <3'
+    assert flipbot.plain_text('<!here> <!subteam^S123|@backend> '
+                              '<!date^1392734382^{date}|Feb 18>', flipper) == \
+        '@here @backend Feb 18'
+
+def test_long_text_rendered(client):
+    client.configure(settings(render_lines_over=3))
+    now = flipbot.time.time()
+    handle(client, {'type': 'message', 'channel': 'C1', 'ts': '%.6f' % now,
+                    'text': 'Traceback:\n  line 1\n  line 2\nError'})
+    handle(client, {'type': 'message', 'channel': 'C1', 'ts': '%.6f' % (now + 1),
+                    'text': 'short\ntext'})
+    methods = [method for method, _ in client._client.calls
+               if method in ('files.upload', 'chat.postMessage')]
+    assert methods == ['files.upload', 'chat.postMessage']
+    assert client.rendered['images'] == 1
+    assert client.rendered['seconds'] > 0
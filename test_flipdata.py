@@ -0,0 +1,74 @@
+''' Compiled flip data tests '''
+
+import os
+
+import pytest
+import upsidedown
+
+import flipdata
+
+@pytest.fixture(scope='module')
+def data():
+    return flipdata.data()
+
+def test_emoji(data):
+    assert data.emoji(':smile:') == ':frowning:'
+    assert data.emoji(':joy:') == ':cry:'
+    assert data.emoji(':shipit:') == '' # flips to a generic wrong way up emoji
+    assert data.emoji(':no_such_emoji:') is None
+    assert data.emoji('') is None
+
+def test_emoji_source(data):
+    with open(flipdata.SOURCE, encoding='utf-8') as f:
+        lines = [line.split() for line in f if line.strip() and line[0] != '#']
+    for words in lines:
+        assert data.emoji(words[0]) == (words[1] if len(words) > 1 else '')
+
+def test_char(data):
+    for c in 'abcxyz019!?([<_ß\u00e9\u2603 ':
+        assert data.char(c) == upsidedown.transform(c)
+    assert data.char('\U0010ffff') == '\U0010ffff'
+
+def test_build_round_trip(tmp_path):
+    source = tmp_path / 'emoji.txt'
+    source.write_text('# comment\n:b: :a:\n:a: :b:\n:c:\n', encoding='utf-8')
+    data = flipdata.FlipData(flipdata.build(str(source)))
+    assert [data.emoji(e) for e in (':a:', ':b:', ':c:', ':d:')] == [':b:', ':a:', '', None]
+    assert data.char('a') == 'ɐ'
+
+def test_not_flip_data():
+    with pytest.raises(ValueError):
+        flipdata.FlipData(b'\0' * 64)
+
+def test_rebuilt_when_stale(tmp_path, monkeypatch):
+    source, path = tmp_path / 'emoji.txt', tmp_path / 'flipdata.bin'
+    source.write_text(':a: :b:\n', encoding='utf-8')
+    monkeypatch.setattr(flipdata, 'SOURCE', str(source))
+    monkeypatch.setattr(flipdata, 'PATH', str(path))
+    monkeypatch.setattr(flipdata, '_data', None)
+    flipdata.write(str(path), str(source))
+    os.utime(str(path), (0, 0)) # older than the source
+    assert flipdata.data().emoji(':a:') == ':b:'
+    assert os.stat(str(path)).st_mtime > 0
+
+def test_built_in_memory_when_read_only(tmp_path, monkeypatch, capsys):
+    source = tmp_path / 'emoji.txt'
+    source.write_text(':a: :b:\n', encoding='utf-8')
+    monkeypatch.setattr(flipdata, 'SOURCE', str(source))
+    monkeypatch.setattr(flipdata, 'PATH', str(tmp_path / 'missing' / 'flipdata.bin'))
+    monkeypatch.setattr(flipdata, '_data', None)
+    assert flipdata.data().emoji(':a:') == ':b:'
+    assert 'Warning: flip data not saved' in capsys.readouterr().err
+
+def test_rebuilt_for_new_upsidedown(tmp_path, monkeypatch):
+    source, path = tmp_path / 'emoji.txt', tmp_path / 'flipdata.bin'
+    source.write_text(':a: :b:\n', encoding='utf-8')
+    monkeypatch.setattr(flipdata, 'SOURCE', str(source))
+    monkeypatch.setattr(flipdata, 'PATH', str(path))
+    monkeypatch.setattr(flipdata, '_data', None)
+    version = flipdata.upsidedown_version()
+    monkeypatch.setattr(flipdata, 'upsidedown_version', lambda: '0.1')
+    flipdata.write()
+    monkeypatch.setattr(flipdata, 'upsidedown_version', lambda: version)
+    assert flipdata.data().version == version
+    assert flipdata.FlipData(flipdata._map(str(path))).version == version
@@ -0,0 +1,198 @@
+''' Property-based and fuzz tests for flip_markedup_text.
+
+Inputs are generated from a seeded random number generator, with a fixed
+seed so that runs are repeatable. Set FLIPBOT_FUZZ_SEED to another seed,
+or to "random" for a new one each run (printed with any failure), and
+FLIPBOT_FUZZ_EXAMPLES to run more examples.
+
+Pathological inputs are checked for linear work by counting what is
+flipped. Set FLIPBOT_FUZZ_TIMING to check wall-clock time too, which is
+only meaningful on a quiet machine.
+'''
+
+import os
+import random
+import time
+import tracemalloc
+
+import pytest
+
+import flipbot
+
+SEED = os.environ.get('FLIPBOT_FUZZ_SEED', '20240101')
+SEED = int(time.time()) if SEED == 'random' else int(SEED)
+EXAMPLES = int(os.environ.get('FLIPBOT_FUZZ_EXAMPLES', 300))
+TIMING = bool(os.environ.get('FLIPBOT_FUZZ_TIMING'))
+
+# Per input character ceilings, generous enough for slow machines, but far
+# below what quadratic behaviour on the pathological inputs would cost.
+MAX_SECONDS_PER_MB = 20.0
+MAX_BYTES_PER_CHAR = 100
+
+TEXT = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 .,!?-\'"\n'
+
+def text(rng, alphabet=TEXT):
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randrange(8)))
+
+def word(rng):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789_-')
+                   for _ in range(rng.randrange(1, 10)))
+
+def markup(rng):
+    '''Return a random slack markup token.'''
+    kind = rng.randrange(6)
+    desc = text(rng).replace('\n', ' ')
+    label = '|' + desc if desc and rng.random() < 0.5 else ''
+    if kind == 0:
+        return ':' + word(rng) + ':'
+    if kind == 1:
+        return '<http://{}.org/{}{}>'.format(word(rng), word(rng), label)
+    if kind == 2:
+        return '<mailto:{}@{}.com{}>'.format(word(rng), word(rng), label)
+    if kind == 3:
+        return '<@U{}{}>'.format(rng.randrange(10000), label)
+    if kind == 4:
+        return '<#C{}{}>'.format(rng.randrange(10000), label)
+    return '<!{}{}>'.format(rng.choice(['here', 'channel', 'everyone']), label)
+
+def message(rng):
+    '''Return a random message of well-formed text and markup.'''
+    return ''.join(rng.choice((text, markup))(rng)
+                   for _ in range(rng.randrange(12)))
+
+def noise(rng):
+    '''Return a random, possibly malformed, message.'''
+    alphabet = TEXT + '<>|:@#!&;' + 'éßж語😀́\t'
+    parts = [message(rng), text(rng, alphabet), '&lt;', '&gt;', '&amp;', '<', '>']
+    return ''.join(rng.choice(parts) for _ in range(rng.randrange(12)))
+
+class Counter(flipbot.FlipMarkedupText):
+    '''Counts the characters flipped.'''
+    def __init__(self):
+        super().__init__({})
+        self.chars = 0
+
+    def flip(self, s):
+        self.chars += len(s)
+        return super().flip(s)
+
+    def emoji(self, s):
+        self.chars += len(s)
+        return super().emoji(s)
+
+class Reverser(flipbot.FlipMarkedupText):
+    '''Flips text by reversing it, so that flipping twice is the identity.'''
+    def flip(self, s):
+        return s[::-1]
+
+    def emoji(self, s):
+        return s
+
+@pytest.fixture
+def rng():
+    print('FLIPBOT_FUZZ_SEED=%d' % SEED)
+    return random.Random(SEED)
+
+def test_double_flip_round_trips(rng):
+    reverser = Reverser({})
+    flip = lambda s: flipbot.flip_markedup_text(s, reverser)
+    for _ in range(EXAMPLES):
+        msg = message(rng)
+        assert flip(flip(msg)) == msg
+
+def test_markup_preserved(rng):
+    flipper = flipbot.FlipMarkedupText({'@U1': 'thomas'})
+    for _ in range(EXAMPLES):
+        msg = message(rng)
+        flipped = flipbot.flip_markedup_text(msg, flipper)
+        # Every reference keeps its target, and every emoji is replaced
+        # by an emoji.
+        targets = lambda s: sorted(m.group(2).partition('|')[0]
+                                   for m in flipbot.markup_re.finditer(s)
+                                   if m.group(2))
+        emojis = lambda s: sum(1 for m in flipbot.markup_re.finditer(s)
+                               if m.group(1))
+        assert targets(flipped) == targets(msg)
+        assert emojis(flipped) >= emojis(msg)
+
+def test_transform_matches_upsidedown(rng):
+    import upsidedown
+    for _ in range(EXAMPLES):
+        s = noise(rng)
+        assert flipbot._transform(s) == upsidedown.transform(s)
+
+def test_flip_many_matches_flip(rng):
+    reverser = Reverser({'@U1': 'thomas'})
+    flipper = flipbot.FlipMarkedupText({'@U1': 'thomas'})
+    flipper.emoji = reverser.emoji # Unknown emojis flip at random
+    msgs = [noise(rng) for _ in range(EXAMPLES)]
+    assert flipbot.flip_many(msgs, flipper) == [
+        flipbot.flip_markedup_text(msg, flipper) for msg in msgs]
+
+def test_noise_never_fails(rng):
+    flipper = flipbot.FlipMarkedupText({'@U1': 'thomas'})
+    for _ in range(EXAMPLES):
+        assert isinstance(flipbot.flip_markedup_text(noise(rng), flipper), str)
+
+def _seconds(text):
+    '''Return the time taken to flip text.'''
+    flipper = flipbot.FlipMarkedupText({})
+    start = time.perf_counter()
+    flipbot.flip_markedup_text(text, flipper)
+    return time.perf_counter() - start
+
+def _peak(text):
+    '''Return the peak memory allocated while flipping text.'''
+    flipper = flipbot.FlipMarkedupText({})
+    tracemalloc.start()
+    try:
+        flipbot.flip_markedup_text(text, flipper)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+PATHOLOGICAL = {
+    'unterminated': '<',
+    'unterminated words': '<a ',
+    'nested': '<<>>',
+    'empty markup': '<>',
+    'emoji colons': ':a',
+    'colons': ':',
+    'user refs': '<@U1>',
+    'escapes': '&lt;&amp;',
+    'mixed': 'hi :smile: <@U1> <http://x.org|x> ',
+}
+
+timing = pytest.mark.skipif(not TIMING, reason='set FLIPBOT_FUZZ_TIMING')
+
+@pytest.mark.parametrize('name', sorted(PATHOLOGICAL))
+def test_linear_work(name):
+    # Each character is flipped at most once, however the markup parses.
+    unit = PATHOLOGICAL[name]
+    text = unit * (200000 // len(unit))
+    counter = Counter()
+    flipbot.flip_markedup_text(text, counter)
+    assert counter.chars <= len(text)
+
+@pytest.mark.parametrize('name', sorted(PATHOLOGICAL))
+def test_memory_ceiling(name):
+    unit = PATHOLOGICAL[name]
+    text = unit * (200000 // len(unit))
+    assert _peak(text) < MAX_BYTES_PER_CHAR * len(text)
+
+@timing
+@pytest.mark.parametrize('name', sorted(PATHOLOGICAL))
+def test_time_ceiling(name):
+    unit = PATHOLOGICAL[name]
+    text = unit * (200000 // len(unit))
+    assert _seconds(text) < MAX_SECONDS_PER_MB * len(text) / 1e6
+
+@timing
+@pytest.mark.parametrize('name', sorted(PATHOLOGICAL))
+def test_linear_time(name):
+    # Quadratic behaviour would make 4 times the input cost 16 times as
+    # long; allow for noise by taking the best of several runs.
+    unit = PATHOLOGICAL[name]
+    best = lambda n: min(_seconds(unit * n) for _ in range(3))
+    n = 20000 // len(unit) + 1
+    assert best(4 * n) < 8 * best(n) + 0.01
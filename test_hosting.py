@@ -0,0 +1,145 @@
+''' Multi-workspace hosting tests '''
+
+import asyncio
+import json
+import time
+
+import slackclient
+
+import config
+import hosting
+from test_flipbot import FakeSlack
+
+def test_host_workspaces(monkeypatch):
+    monkeypatch.setattr(slackclient, 'SlackClient', FakeSlack)
+    host = hosting.Host({name: config.Config(token='xoxb-' + name, user='UBOT')
+                         for name in ('acme', 'globex')}, io_threads=2)
+
+    async def run():
+        task = asyncio.ensure_future(host.run(poll_interval=0.01))
+        while len(host.clients) < 2:
+            await asyncio.sleep(0.01)
+        for name, client in host.clients.items():
+            client._client.frames = [
+                [{'type': 'message', 'channel': 'C1', 'ts': '1.0', 'text': name}],
+                ConnectionError('socket closed')]
+        while not all(len(c._client.posted()) == 1 for c in host.clients.values()):
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(asyncio.wait_for(run(), 10))
+    acme, globex = host.clients['acme'], host.clients['globex']
+    assert acme._flipper is not globex._flipper
+    assert acme.policy is not globex.policy
+    assert acme._client.posted()[0]['text'] == 'ǝɯɔɐ'
+
+def test_failing_workspace_holds_no_thread(monkeypatch):
+    def slack(token):
+        fake = FakeSlack(token)
+        if token == 'xoxb-revoked':
+            fake.connects = [False] * 10000
+        return fake
+    monkeypatch.setattr(slackclient, 'SlackClient', slack)
+    configs = {name: config.Config(token='xoxb-' + name, user='UBOT',
+                                   reconnect_initial=60, reconnect_max=60)
+               for name in ('revoked', 'acme')}
+    host = hosting.Host(configs, io_threads=1)
+
+    async def run():
+        task = asyncio.ensure_future(host.run(poll_interval=0.01))
+        while len(host.clients) < 2:
+            await asyncio.sleep(0.01)
+        acme = host.clients['acme']
+        acme._client.frames = [
+            [{'type': 'message', 'channel': 'C1', 'ts': '1.0', 'text': 'acme'}]]
+        while not acme._client.posted():
+            await asyncio.sleep(0.01)
+        host.stop()
+        await task # Stops without waiting out the revoked workspace's backoff
+
+    asyncio.run(asyncio.wait_for(run(), 10))
+    assert not host.clients['revoked'].connected
+
+def test_load_workspaces(tmp_path):
+    path = tmp_path / 'settings.ini'
+    path.write_text('[SETTINGS]\n'
+                    'USER = UBOT\n'
+                    '[POLICY]\n'
+                    'USER_COOLDOWN = 10\n'
+                    '[WORKSPACE acme]\n'
+                    'TOKEN = xoxb-acme\n'
+                    '[WORKSPACE globex]\n'
+                    'TOKEN = xoxb-globex\n'
+                    'USER = UGLOBEX\n')
+    configs = hosting.load(str(path), threaded=True)
+    assert sorted(configs) == ['acme', 'globex']
+    assert configs['acme'].token == 'xoxb-acme'
+    assert configs['acme'].user == 'UBOT'
+    assert configs['globex'].user == 'UGLOBEX'
+    assert configs['globex'].threaded
+    # Each workspace throttles independently
+    assert configs['acme'].policy is not configs['globex'].policy
+
+def _settings(tmp_path):
+    path = tmp_path / 'settings.ini'
+    path.write_text('[SETTINGS]\n'
+                    'USER = UBOT\n'
+                    'STATE_FILE = {0}/state.json\n'
+                    'DEDUP_FILE = {0}/seen.log\n'
+                    '[WORKSPACE acme]\n'
+                    'TOKEN = xoxb-acme\n'
+                    '[WORKSPACE globex]\n'
+                    'TOKEN = xoxb-globex\n'
+                    'DEDUP_FILE = {0}/globex.log\n'.format(tmp_path))
+    return str(path)
+
+def test_workspace_files(tmp_path):
+    configs = hosting.load(_settings(tmp_path))
+    assert configs['acme'].state_file == str(tmp_path / 'state.json.acme')
+    assert configs['globex'].state_file == str(tmp_path / 'state.json.globex')
+    assert configs['acme'].dedup_file == str(tmp_path / 'seen.log.acme')
+    assert configs['globex'].dedup_file == str(tmp_path / 'globex.log')
+
+def test_workspace_state_survives_restart(monkeypatch, tmp_path):
+    monkeypatch.setattr(slackclient, 'SlackClient', FakeSlack)
+    path = _settings(tmp_path)
+    messages = {'acme': {'type': 'message', 'channel': 'C1', 'ts': '1.0', 'text': 'a'},
+                'globex': {'type': 'message', 'channel': 'C1', 'ts': '2.0', 'text': 'g'}}
+
+    def run(host, frames):
+        async def serve():
+            task = asyncio.ensure_future(host.run(poll_interval=0.01))
+            while len(host.clients) < 2:
+                await asyncio.sleep(0.01)
+            for name, client in host.clients.items():
+                client._client.frames = [frames(name)]
+            while any(c._client.frames for c in host.clients.values()):
+                await asyncio.sleep(0.01)
+            host.stop()
+            await task
+        asyncio.run(asyncio.wait_for(serve(), 10))
+
+    run(hosting.Host(hosting.load(path)), lambda name: [messages[name]])
+    for name in messages:
+        with open(str(tmp_path / ('state.json.' + name))) as f:
+            assert json.load(f)['last_ts'] == messages[name]['ts']
+    # Slack replays both messages to both workspaces after the restart
+    host = hosting.Host(hosting.load(path))
+    run(host, lambda name: list(messages.values()))
+    flipped = {'acme': 'ƃ', 'globex': 'ɐ'} # only the other's message
+    for name, client in host.clients.items():
+        assert client._dedup.dropped == 1
+        assert [p['text'] for p in client._client.posted()] == [flipped[name]]
+
+def test_watcher_loads_workspaces(tmp_path):
+    path = _settings(tmp_path)
+    changes = []
+    watcher = config.Watcher(path, changes.append, interval=0.01,
+                             load=hosting.load, verbose=True)
+    with open(path, 'a') as f:
+        f.write('THREADED = yes\n')
+    deadline = time.time() + 5
+    while not changes and time.time() < deadline:
+        time.sleep(0.01)
+    watcher.stop()
+    assert changes[0]['globex'].threaded and changes[0]['acme'].verbose
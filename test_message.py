@@ -0,0 +1,78 @@
+''' Message model tests '''
+
+import json
+import sys
+
+import pytest
+
+from message import File, Message
+
+EVENT = {
+    'type': 'message', 'channel': 'C1', 'user': 'U1', 'ts': '1.5',
+    'text': 'hello', 'client_msg_id': 'a1b2', 'team': 'T1',
+    'blocks': [{'type': 'rich_text', 'elements': [
+        {'type': 'rich_text_section',
+         'elements': [{'type': 'text', 'text': 'hello'}]}]}],
+}
+
+def test_parse():
+    msg = Message.parse(EVENT)
+    assert (msg.type, msg.subtype, msg.channel, msg.user, msg.ts, msg.text) == \
+        ('message', None, 'C1', 'U1', '1.5', 'hello')
+    assert msg.key == ('message', None)
+    assert msg.file is msg.edited is msg.thread_ts is None
+    assert Message.parse({'type': 'message', 'subtype': ''}).subtype is None
+    assert repr(Message.parse({'type': 'hello'})) == "Message(type='hello')"
+    with pytest.raises(AttributeError):
+        msg.blocks = EVENT['blocks']
+
+def test_parse_file_share():
+    f = {'name': 'cat.png', 'mimetype': 'image/png', 'title': 'Cat',
+         'url_private_download': 'https://files/cat.png',
+         'initial_comment': {'comment': 'look'}, 'thumb_64': 'https://t'}
+    for event in {'file': f}, {'files': [f]}:
+        msg = Message.parse(dict(event, type='message', subtype='file_share'))
+        assert (msg.file.name, msg.file.mimetype, msg.file.url,
+                msg.file.title, msg.file.comment) == \
+            ('cat.png', 'image/png', 'https://files/cat.png', 'Cat', 'look')
+    assert File.parse({}).mimetype == ''
+
+def test_thumbs():
+    f = File.parse({'original_w': 4000, 'original_h': 3000,
+                    'thumb_360': 'https://t360', 'thumb_360_w': 360,
+                    'thumb_1024': 'https://t1024', 'thumb_64': 'https://t64'})
+    assert f.size == 4000
+    assert f.thumbs == ((64, 'https://t64'), (360, 'https://t360'),
+                        (1024, 'https://t1024'))
+    assert f.thumb(720) == (360, 'https://t360')
+    assert f.thumb(32) is None
+
+def test_parse_edit():
+    msg = Message.parse({'type': 'message', 'subtype': 'message_changed',
+                         'channel': 'C1', 'ts': '2.0',
+                         'message': {'ts': '1.0', 'user': 'U1', 'text': 'new'},
+                         'previous_message': {'ts': '1.0', 'text': 'old'}})
+    assert (msg.edited.ts, msg.edited.user, msg.edited.text) == ('1.0', 'U1', 'new')
+    assert msg.previous_text == 'old'
+
+def test_parse_objects():
+    # Some events carry a user or channel object, rather than its id
+    msg = Message.parse({'type': 'user_change',
+                         'user': {'id': 'U1', 'name': 'ann', 'profile': {}}})
+    assert (msg.key, msg.user) == (('user_change', None), 'U1')
+    msg = Message.parse({'type': 'channel_rename',
+                         'channel': {'id': 'C1', 'name': 'general', 'created': 1}})
+    assert msg.channel == 'C1'
+    assert Message.parse({'type': 'team_join', 'user': {}}).user is None
+
+def test_smaller_than_event():
+    def size(obj):
+        if isinstance(obj, dict):
+            return sys.getsizeof(obj) + sum(size(k) + size(v) for k, v in obj.items())
+        if isinstance(obj, list):
+            return sys.getsizeof(obj) + sum(map(size, obj))
+        return sys.getsizeof(obj)
+    event = json.loads(json.dumps(EVENT))
+    msg = Message.parse(event)
+    # Interned ids and types are shared between messages.
+    assert sys.getsizeof(msg) + size(msg.ts) + size(msg.text) < size(event) / 10
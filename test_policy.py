@@ -0,0 +1,77 @@
+''' Flip policy tests '''
+
+import configparser
+import random
+
+import policy
+
+def read_policy(path):
+    parser = configparser.ConfigParser()
+    parser.read(path)
+    return policy.parse_policy(parser)
+
+def test_default_allows_everything():
+    p = policy.Policy()
+    assert all(p.allow('C1', 'U1', now=0) for _ in range(100))
+
+def test_allow_and_deny_lists():
+    p = policy.Policy(allow_channels=['C1', 'C2'], deny_channels=['C2'],
+                      deny_users=['UBAD'])
+    assert p.allow('C1', 'U1')
+    assert not p.allow('C2', 'U1')
+    assert not p.allow('C3', 'U1')
+    assert not p.allow('C1', 'UBAD')
+    assert p.stats == {'denied': 3}
+
+def test_sampling():
+    random.seed(1)
+    p = policy.Policy(sample=0.5, channel_sample={'C2': 0})
+    flipped = sum(p.allow('C1', 'U1') for _ in range(1000))
+    assert 400 < flipped < 600
+    assert not any(p.allow('C2', 'U1') for _ in range(100))
+
+def test_user_cooldown():
+    p = policy.Policy(user_cooldown=10)
+    assert p.allow('C1', 'U1', now=0)
+    assert p.allow('C1', 'U2', now=1)
+    assert not p.allow('C1', 'U1', now=5)
+    assert p.allow('C1', 'U1', now=10)
+    assert p.stats == {'cooldown': 1}
+
+def test_channel_token_bucket():
+    p = policy.Policy(channel_rate=0.5, channel_burst=2)
+    assert [p.allow('C1', 'U1', now=0) for _ in range(3)] == [True, True, False]
+    assert p.allow('C2', 'U1', now=0)
+    assert not p.allow('C1', 'U1', now=1)
+    assert p.allow('C1', 'U1', now=2)
+
+def test_reload(tmp_path):
+    path = tmp_path / 'settings.ini'
+    path.write_text('[POLICY]\n'
+                    'DENY_USERS = U9\n'
+                    'CHANNEL_SAMPLE = C1:0.25 C2:0\n'
+                    'USER_COOLDOWN = 10\n')
+    p = read_policy(str(path))
+    assert p.deny_users == {'U9'}
+    assert p.channel_sample == {'C1': 0.25, 'C2': 0}
+    assert p.allow('C3', 'U1', now=0)
+    path.write_text('[POLICY]\nUSER_COOLDOWN = 20\n')
+    p = read_policy(str(path)).inherit(p)
+    assert not p.allow('C3', 'U1', now=15)
+    assert p.allow('C3', 'U9', now=15)
+    assert read_policy(str(tmp_path / 'missing.ini')).allow('C', 'U')
+
+def test_concurrent_checks():
+    import threading
+    p = policy.Policy(channel_rate=1e-9, channel_burst=100)
+    allowed = []
+
+    def check():
+        allowed.extend(p.allow('C1', 'U1', now=0) for _ in range(200))
+    threads = [threading.Thread(target=check) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(allowed) == 100
+    assert p.stats == {'rate': 1500}
@@ -0,0 +1,57 @@
+''' Sampling profiler tests '''
+
+import os
+import signal
+import threading
+import time
+
+import profiler
+
+def busy(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+def test_sample():
+    stop = threading.Event()
+    thread = threading.Thread(target=busy, args=(stop,), name='worker')
+    thread.start()
+    try:
+        stacks = profiler.sample(0.1, interval=0.001)
+    finally:
+        stop.set()
+        thread.join()
+    worker = [s for s in stacks if s.startswith('worker;')]
+    assert worker
+    assert all('test_profiler.py:busy' in s for s in worker)
+    assert not any('profiler.py:sample' in s for s in stacks) # not itself
+
+def test_write_folded(tmp_path):
+    path = str(tmp_path / 'out.folded')
+    profiler.write_folded({'main;a;b': 3, 'main;a': 1}, path)
+    with open(path) as f:
+        assert f.read() == 'main;a 1\nmain;a;b 3\n'
+
+def wait_for(path):
+    for _ in range(100):
+        if os.path.exists(path):
+            return True
+        time.sleep(0.05)
+    return False
+
+def test_start_once(tmp_path):
+    path = profiler.start(0.2, str(tmp_path))
+    assert path.startswith(str(tmp_path))
+    assert profiler.start(0.2, str(tmp_path)) is None
+    assert wait_for(path)
+
+def test_signal(tmp_path):
+    old = signal.getsignal(signal.SIGUSR2)
+    try:
+        profiler.install(0.05, str(tmp_path))
+        while profiler._profiler.running:
+            time.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGUSR2)
+        time.sleep(0.2)
+        assert any(name.endswith('.folded') for name in os.listdir(str(tmp_path)))
+    finally:
+        signal.signal(signal.SIGUSR2, old)
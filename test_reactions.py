@@ -0,0 +1,63 @@
+''' Reaction queue tests '''
+
+import threading
+
+import reactions
+
+class Recorder:
+    def __init__(self, result=None):
+        self.calls = []
+        self.result = result or {'ok': True}
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, method, **kwargs):
+        self.release.wait()
+        self.calls.append((kwargs['channel'], kwargs['timestamp'], kwargs['name']))
+        return self.result
+
+def test_collapse_and_flush():
+    api = Recorder()
+    queue = reactions.ReactionQueue(api)
+    with queue.holding():
+        queue.add('C1', '1.0', 'umbrella')
+        queue.add('C1', '1.0', 'flag-au')
+        queue.add('C1', '2.0', 'umbrella')
+        assert api.calls == []
+    assert queue.flush(5) == 0
+    assert api.calls == [('C1', '1.0', 'umbrella'), ('C1', '2.0', 'umbrella')]
+    assert queue.stats == {'added': 2, 'collapsed': 1}
+
+def test_reacted_not_repeated():
+    api = Recorder()
+    queue = reactions.ReactionQueue(api)
+    queue.add('C1', '1.0', 'umbrella')
+    queue.flush(5)
+    queue.add('C1', '1.0', 'umbrella')
+    assert queue.flush(5) == 0
+    assert len(api.calls) == 1
+
+def test_oldest_dropped():
+    api = Recorder()
+    queue = reactions.ReactionQueue(api, maxlen=2)
+    with queue.holding():
+        for ts in '1.0', '2.0', '3.0':
+            queue.add('C1', ts, 'umbrella')
+    queue.flush(5)
+    assert [ts for _, ts, _ in api.calls] == ['2.0', '3.0']
+    assert queue.stats['dropped'] == 1
+
+def test_flush_timeout():
+    api = Recorder()
+    api.release.clear()
+    queue = reactions.ReactionQueue(api)
+    queue.add('C1', '1.0', 'umbrella')
+    queue.add('C1', '2.0', 'umbrella')
+    assert queue.flush(0.05) == 1
+    api.release.set()
+
+def test_errors_counted():
+    queue = reactions.ReactionQueue(Recorder({'ok': False, 'error': 'already_reacted'}))
+    queue.add('C1', '1.0', 'umbrella')
+    queue.flush(5)
+    assert queue.stats == {'already_reacted': 1}
@@ -0,0 +1,44 @@
+''' Text rendering tests '''
+
+import io
+
+from PIL import Image
+
+import render
+
+def test_wrap():
+    assert render.wrap('ab\tc\n\nxyz\x07', columns=3) == ['ab ', ' c', '', 'xyz']
+    assert render.wrap('a\n' * 10, max_lines=4) == ['a', 'a', 'a', '…']
+
+def test_atlas_cached():
+    atlas = render.atlas()
+    assert render.atlas() is atlas
+    mask, advance = atlas.glyph('M')
+    assert atlas.glyph('M')[0] is mask
+    assert advance > 0
+    assert atlas.glyph(' ')[0] is None
+
+def test_atlas_bounded():
+    atlas = render.GlyphAtlas(render.atlas().font, max_glyphs=10)
+    for code in range(0x4e00, 0x4e00 + 100):
+        atlas.glyph(chr(code))
+    assert atlas.glyph.cache_info().currsize == 10
+    assert atlas.render([chr(0x4e00)]).size[0] > 2 * render.MARGIN
+
+def test_render_text_upside_down():
+    img = Image.open(io.BytesIO(render.render_text('MMMM\n\n\n\n')))
+    width, height = img.size
+    top = img.crop((0, 0, width, height // 2)).getextrema()
+    bottom = img.crop((0, height // 2, width, height)).getextrema()
+    assert top == (255, 255)   # the blank lines, turned over
+    assert bottom[0] < 128     # the text
+
+def test_render_matches_image_draw():
+    from PIL import ImageDraw, ImageChops
+    atlas = render.atlas()
+    drawn = atlas.render(['Hi'])
+    expected = Image.new('L', drawn.size, 255)
+    ImageDraw.Draw(expected).text((render.MARGIN, render.MARGIN), 'Hi',
+                                  fill=0, font=atlas.font)
+    ink = lambda img: ImageChops.invert(img).getbbox()
+    assert ink(drawn) == ink(expected)
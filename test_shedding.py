@@ -0,0 +1,27 @@
+''' Load shedding tests '''
+
+import shedding
+
+def test_levels():
+    shedder = shedding.LoadShedder((10, 60, 300))
+    assert shedder.measure('1000.000100', now=1005) == shedding.NORMAL
+    assert shedder.measure('1000.0', now=1011) == shedding.REACTIONS
+    assert shedder.lag == 11
+    assert shedder.measure('1000.0', now=1100) == shedding.IMAGES
+    assert shedder.measure('1000.0', now=1301) == shedding.MESSAGES
+    assert shedder.level == shedding.MESSAGES
+
+def test_disabled_thresholds():
+    shedder = shedding.LoadShedder((0, 0, 0))
+    assert shedder.measure('0', now=1e9) == shedding.NORMAL
+    shedder = shedding.LoadShedder((0, 0, 100))
+    assert shedder.measure('0', now=101) == shedding.MESSAGES
+
+def test_allow():
+    shedder = shedding.LoadShedder((10, 60, 300))
+    level = shedder.measure('0', now=20)
+    shedder.measure('0', now=1000) # another message, in another thread
+    assert not shedder.allow(shedding.REACTIONS, level)
+    assert shedder.allow(shedding.IMAGES, level)
+    assert shedder.allow(shedding.MESSAGES, level)
+    assert shedder.shed == {'reactions': 1}